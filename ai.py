@@ -1,10 +1,51 @@
+import hashlib
+import json
+import queue
 import re
-import requests
+import threading
+import time
+
 from loguru import logger
 
-from config import OPENROUTER_API_KEY, OPENROUTER_MODEL
+import http_client
+import ratelimit
+import tracing
+
+from config import OPENROUTER_API_KEY, OPENROUTER_MODELS, OPENROUTER_API_URL
+from database import get_state, set_state, get_document, evict
+
+API_URL = OPENROUTER_API_URL
+
+# Кэш разобранных ответов по содержимому запроса. Если ИИ ответил, а статья
+# потом отвалилась на картинке, следующий прогон снова возьмёт её — и без
+# кэша снова потратит запрос из дневной квоты OpenRouter на тот же ответ.
+LLM_CACHE_TTL = 7 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 200
 
-API_URL = 'https://openrouter.ai/api/v1/chat/completions'
+# Сколько раз заходить на новый круг по моделям, если все ответили 429 или
+# ошибкой — с паузой, которую назвал OpenRouter (см. ratelimit.throttled).
+RATE_LIMIT_RETRIES = 2
+# Сколько ждать ответа модели, прежде чем продублировать запрос следующей.
+# Бесплатные модели обычно отвечают за секунды, но хвост — до минуты.
+HEDGE_DELAY = 15
+# Хеджировать, только пока в суточной квоте OpenRouter остаётся больше
+# этого: дубль — это ещё один запрос из неё.
+HEDGE_MIN_QUOTA = 10
+# Вес нового замера в скользящей статистике моделей (data/llm_models.json).
+MODEL_STATS_ALPHA = 0.3
+# Пауза модели после 429 без Retry-After.
+MODEL_BLOCK = 300
+
+# Признаки выродившейся генерации, замеченные вживую: повторяющиеся
+# <unk>, рассуждения вслух в <think>, один и тот же токен по кругу.
+# Проверяются по ходу потока на последних DEGENERATE_WINDOW символах.
+DEGENERATE_RE = re.compile(r'(?:<unk>\s*){3,}|</?think>|(\w{2,40}?)(?:\s*\1){12,}')
+DEGENERATE_WINDOW = 600
+# Если за столько символов не появилось ни одного «Заголовок:» — модель
+# пишет не ответ (рассуждение, отказ, пересказ промпта).
+FORMAT_GRACE_CHARS = 400
+
+_models_lock = threading.Lock()
 
 # Один запрос делает и перевод, и суммаризацию сразу — при дневном лимите
 # бесплатных запросов на OpenRouter два отдельных вызова на статью съели бы
@@ -42,6 +83,35 @@ PROMPT = (
     "Текст статьи:\n{text}"
 )
 
+# Пакетный режим: несколько статей в одном запросе. Формат полей тот же,
+# что в PROMPT, но каждая статья и каждый ответ — в своём разделе с номером,
+# по которому ответ сопоставляется со статьёй (см. process_batch).
+BATCH_PROMPT = (
+    "Тебе даны {count} статей (на русском или английском языке), каждая в "
+    "разделе «### Статья N».\n"
+    "Для КАЖДОЙ статьи ответь отдельным разделом, который начинается строкой "
+    "«### Статья N» с тем же номером, и внутри него строго четыре поля:\n"
+    "Заголовок: <заголовок на русском, не длиннее 100 символов>\n"
+    "Текст: <выжимка на русском, 3-5 предложений, только факты, без вводных "
+    "фраз вроде «в статье говорится»>\n"
+    "Теги: <2-3 коротких хэштега по теме статьи на русском, каждый одним "
+    "словом, без решётки, через запятую, например: нейросети, технологии>\n"
+    "Картинка: <краткое описание на английском для иллюстрации, 5-10 слов, "
+    "конкретная сцена или объект, который можно нарисовать — не абстрактные "
+    "понятия вроде 'separation of concerns' или 'data privacy'>\n\n"
+    "Не смешивай статьи между собой: каждый раздел — только про свою статью.\n"
+    "Если оригинал уже на русском — не переводи дословно, а сократи своими словами.\n"
+    "Напоминание: поля «Заголовок», «Текст» и «Теги» должны быть полностью на "
+    "русском языке, без единого слова на английском или другом языке (кроме "
+    "имён собственных). Поле «Картинка» — всегда на английском.\n\n"
+    "{articles}"
+)
+BATCH_ARTICLE = "### Статья {number}\nЗаголовок статьи: {title}\n\nТекст статьи:\n{text}"
+
+# Заголовок раздела пакетного ответа. Терпим к оформлению: модели пишут
+# и «### Статья 2», и «**Статья 2:**», и «Статья №2».
+BATCH_SECTION_RE = re.compile(r'^[ \t]*#*[ \t]*\**[ \t]*Статья[ \t]*№?[ \t]*(\d+)\**[ \t]*[:.)]?\**[ \t]*$', re.MULTILINE)
+
 # \s* вместо \s*\n+\s* между полями: вживую модель иногда пишет "Картинка:"
 # в той же строке, сразу после текста выжимки, без переноса — с обязательным
 # \n+ такие ответы (примерно половина!) не матчились и терялись зря.
@@ -74,39 +144,327 @@ def split_into_paragraphs(text, sentences_per_paragraph=2):
     return '\n\n'.join(paragraphs)
 
 
-def process_article(title, text):
-    """Возвращает (заголовок_ru, выжимка_ru, промпт_для_картинки_en, теги_ru).
-    При любой ошибке — ('', '', '', ''), чтобы вызывающий код просто пропустил
-    статью, а не упал."""
-    if not text:
-        return '', '', '', ''
+def _cache_key(title, text):
+    # В ключ входит всё, от чего зависит ответ: набор моделей и оба промпта
+    # тоже — правка промпта должна давать новые ответы, а не старые из кэша.
+    # Набор, а не конкретная модель: какая из них ответит, решает гонка.
+    material = json.dumps([sorted(OPENROUTER_MODELS), SYSTEM_PROMPT, PROMPT, title, text], ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def _cache_get(key):
+    cached = get_state(key, default=None, doc='llm_cache')
+    if cached and time.time() - cached['ts'] < LLM_CACHE_TTL:
+        tracing.incr('llm.cache_hits')
+        return tuple(cached['result'])
+    tracing.incr('llm.cache_misses')
+    return None
+
+
+def _cache_put(key, result):
+    set_state(key, {'ts': int(time.time()), 'result': list(result)}, doc='llm_cache')
+    evict('llm_cache', LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES)
+
+
+def _models():
+    """Модели в порядке попыток: по ожидаемой «цене» ответа — задержке,
+    делённой на долю успехов. У модели без истории — нейтральные значения,
+    так что свежий конфиг сначала идёт как есть. Модели на паузе после 429
+    не предлагаются вовсе."""
+    stats = get_document('llm_models')
+    now = time.time()
+
+    def cost(item):
+        index, model = item
+        entry = stats.get(model, {})
+        return entry.get('latency', HEDGE_DELAY) / max(entry.get('success', 0.5), 0.05), index
+
+    return [
+        model for _, model in sorted(enumerate(OPENROUTER_MODELS), key=cost)
+        if stats.get(model, {}).get('blocked_until', 0) <= now
+    ]
+
+
+def _record_model(model, latency=None, ok=False, blocked_for=None):
+    with _models_lock:
+        entry = dict(get_state(model, default=None, doc='llm_models') or {})
+        entry['success'] = round((1 - MODEL_STATS_ALPHA) * entry.get('success', 0.5) + MODEL_STATS_ALPHA * ok, 4)
+        if latency is not None:
+            previous = entry.get('latency', latency)
+            entry['latency'] = round((1 - MODEL_STATS_ALPHA) * previous + MODEL_STATS_ALPHA * latency, 3)
+        if blocked_for is not None:
+            entry['blocked_until'] = round(time.time() + blocked_for, 3)
+        entry['calls'] = entry.get('calls', 0) + 1
+        set_state(model, entry, doc='llm_models')
+
+
+class DegenerateOutput(Exception):
+    """Модель выдаёт мусор — дочитывать ответ нет смысла."""
+
+
+def _single_end(content):
+    # Ответ готов, когда после «Картинка:» закончилась строка: дальше модель
+    # либо замолкает, либо пишет то, что в пост всё равно не попадёт.
+    match = RESPONSE_RE.search(content)
+    if not match:
+        return None
+    newline = content.find('\n', match.start('image_prompt'))
+    return newline if newline != -1 else None
+
+
+def _batch_end(count):
+    def end(content):
+        markers = list(BATCH_SECTION_RE.finditer(content))
+        if len(markers) < count:
+            return None
+        tail = _single_end(content[markers[-1].end():])
+        return None if tail is None else markers[-1].end() + tail
+    return end
+
+
+def _watch(content, end):
+    """Проверка ответа по ходу потока: бросает DegenerateOutput на мусоре,
+    возвращает длину готового ответа, если все поля уже пришли, иначе None."""
+    match = DEGENERATE_RE.search(content[-DEGENERATE_WINDOW:])
+    if match:
+        raise DegenerateOutput(f"ответ выродился: {match.group(0)[:60]!r}")
+    if len(content) >= FORMAT_GRACE_CHARS and 'Заголовок:' not in content:
+        raise DegenerateOutput(f"ответ не в формате: {content[:120]!r}")
+    return end(content) if end else None
+
+
+def _read_stream(response, end, cancel):
+    """Читает ответ в режиме stream (SSE) и разбирает его на лету: обрывает
+    на мусоре (см. _watch) и как только все поля ответа готовы. None — если
+    запрос отменили (победила другая модель)."""
+    content = ''
+    # Байтами, а не decode_unicode: у text/event-stream без charset
+    # requests считает кодировку latin-1 и ломает кириллицу.
+    for line in response.iter_lines():
+        if cancel.is_set():
+            response.close()
+            return None
+        # Строки-комментарии (": OPENROUTER PROCESSING") держат соединение
+        # живым, пока модель думает, — пропускаем.
+        if not line.startswith(b'data:'):
+            continue
+        data = line[len(b'data:'):].strip()
+        if data == b'[DONE]':
+            break
+        chunk = json.loads(data)
+        if 'error' in chunk:
+            raise RuntimeError(f"ошибка посреди ответа: {chunk['error']}")
+        # Служебные куски без текста (в конце OpenRouter шлёт usage с
+        # пустым choices) ничего не добавляют.
+        piece = ((chunk.get('choices') or [{}])[0].get('delta') or {}).get('content')
+        if not piece:
+            continue
+        content += piece
+        done = _watch(content, end)
+        if done is not None:
+            tracing.incr('llm.stream_early_done')
+            response.close()
+            return content[:done].strip()
+    response.close()
+    return content.strip()
+
 
+def _request(model, user_content, max_tokens, validate, end, cancel):
+    """Один запрос к одной модели: (текст ответа, прошедший validate, или
+    None; упёрлась ли модель в 429 — тогда её можно спросить позже).
+    Ответ читается потоком (см. _read_stream): мусор обрывается через
+    секунду, а не по таймауту, а готовый ответ не ждёт хвоста генерации."""
+    if cancel.is_set():
+        return None, False
     payload = {
-        'model': OPENROUTER_MODEL,
+        'model': model,
         'messages': [
             {'role': 'system', 'content': SYSTEM_PROMPT},
-            {'role': 'user', 'content': PROMPT.format(title=title, text=text)},
+            {'role': 'user', 'content': user_content},
         ],
         'temperature': 0.3,
-        'max_tokens': 500,
+        'max_tokens': max_tokens,
         # Часть бесплатных моделей — reasoning-модели: без этого флага они
         # тратят весь max_tokens на рассуждения вслух и обрезаются раньше,
         # чем успевают выдать сам ответ (поймали вживую: content содержал
         # заглушку из промпта и оборванное рассуждение вместо результата).
         'reasoning': {'enabled': False},
+        'stream': True,
     }
     headers = {'Authorization': f'Bearer {OPENROUTER_API_KEY}'}
 
+    started = time.monotonic()
+    try:
+        # Повторы по 5xx и 429 — не здесь: вместо повтора той же модели
+        # запрос уходит следующей (см. _complete).
+        response = http_client.post(API_URL, json=payload, headers=headers, retries=0, stream=True)
+    except Exception as e:
+        logger.warning(f"OpenRouter {model}: {e}")
+        _record_model(model)
+        return None, False
+
+    if response.status_code == 429:
+        # X-RateLimit-Remaining: 0 — кончился лимит аккаунта, он общий для
+        # всех моделей; без него 429 — перегружен пул этой модели.
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            ratelimit.throttled('openrouter', response)
+            _record_model(model)
+        else:
+            wait = http_client.retry_after(response)
+            _record_model(model, blocked_for=MODEL_BLOCK if wait is None else wait)
+            logger.warning(f"OpenRouter {model}: HTTP 429, модель на паузе")
+        return None, True
     try:
-        response = requests.post(API_URL, json=payload, headers=headers, timeout=60)
         response.raise_for_status()
-        content = response.json()['choices'][0]['message']['content'].strip()
+        if 'text/event-stream' in response.headers.get('Content-Type', ''):
+            content = _read_stream(response, end, cancel)
+        else:
+            content = response.json()['choices'][0]['message']['content'].strip()
+    except DegenerateOutput as e:
+        response.close()
+        tracing.incr('llm.stream_aborts')
+        logger.warning(f"OpenRouter {model}: {e}, обрываю ответ через {time.monotonic() - started:.1f} с")
+        _record_model(model)
+        return None, False
     except Exception as e:
-        logger.error(f"Ошибка запроса к OpenRouter: {e}")
-        return '', '', '', ''
+        response.close()
+        logger.warning(f"OpenRouter {model}: {e}")
+        _record_model(model)
+        return None, False
+    if content is None:
+        return None, False
+
+    ok = bool(content) and validate(content)
+    _record_model(model, latency=time.monotonic() - started, ok=ok)
+    if not ok:
+        logger.warning(f"OpenRouter {model}: ответ не в ожидаемом формате: {content[:200]!r}")
+        return None, False
+    return content, False
+
+
+@tracing.traced('ai.request')
+def _complete(user_content, max_tokens, validate=bool, end=None):
+    """Запрос к OpenRouter с хеджированием по моделям (OPENROUTER_MODELS):
+    если модель не ответила за HEDGE_DELAY, тот же запрос параллельно
+    уходит следующей; на 429/5xx или ответ не в формате — следующей сразу.
+    Побеждает первый ответ, прошедший validate, остальные отменяются.
+    end(текст) — где кончается готовый ответ (см. _read_stream).
+    Возвращает текст ответа или '' — если не ответила ни одна модель или
+    лимит не даёт звать OpenRouter в этом прогоне.
+
+    Хедж — лишний запрос из суточной квоты, поэтому он уходит, только пока в
+    квоте остаётся больше HEDGE_MIN_QUOTA и слот есть без ожидания.
+    На новый круг идут только модели, упёршиеся в 429: ошибку или мусор
+    в ответе повторный запрос той же модели обычно не исправит."""
+    failed = set()
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        candidates = [m for m in OPENROUTER_MODELS if m not in failed]
+        if not candidates:
+            break
+        models = [m for m in _models() if m not in failed]
+        if not models:
+            stats = get_document('llm_models')
+            wait = min(stats.get(m, {}).get('blocked_until', 0) for m in candidates) - time.time()
+            if wait > ratelimit.MAX_WAIT:
+                break
+            time.sleep(max(0, wait))
+            continue
+
+        cancel = threading.Event()
+        finished = queue.Queue()
+        launched = running = 0
+
+        def request(model):
+            # Ответ кладём в очередь при любом исходе, как в images.fetch_image:
+            # иначе цикл ниже ждал бы упавший запрос вечно.
+            content, throttled = '', False
+            try:
+                content, throttled = _request(model, user_content, max_tokens, validate, end, cancel)
+            except Exception:
+                logger.exception(f"OpenRouter: запрос к {model} упал")
+            finally:
+                finished.put((model, content, throttled))
+
+        def launch(hedge):
+            nonlocal launched, running
+            if hedge:
+                remaining = ratelimit.remaining('openrouter')
+                if remaining is not None and remaining <= HEDGE_MIN_QUOTA:
+                    return False
+            if not ratelimit.acquire('openrouter', max_wait=0 if hedge else ratelimit.MAX_WAIT):
+                return False
+            model = models[launched]
+            launched += 1
+            running += 1
+            if hedge:
+                tracing.incr('llm.hedges')
+                logger.info(f"OpenRouter: {models[launched - 2]} молчит {HEDGE_DELAY} с, дублирую запрос в {model}")
+            # Потоки-демоны, как в images.fetch_image: зависший запрос
+            # проигравшей модели не должен держать выход из процесса.
+            threading.Thread(target=request, args=(model,), daemon=True).start()
+            return True
+
+        if not launch(hedge=False):
+            return ''
+        hedging = True
+        try:
+            while running:
+                can_hedge = hedging and launched < len(models)
+                try:
+                    model, content, throttled = finished.get(timeout=HEDGE_DELAY if can_hedge else None)
+                except queue.Empty:
+                    hedging = launch(hedge=True)
+                    continue
+                running -= 1
+                if content:
+                    return content
+                if not throttled:
+                    failed.add(model)
+                if launched < len(models):
+                    launch(hedge=False)
+        finally:
+            cancel.set()
+        if ratelimit.deferred('openrouter'):
+            break
+
+    logger.error("OpenRouter: ни одна модель не ответила")
+    return ''
 
+
+def _parse(content):
+    """Разбирает один блок ответа по RESPONSE_RE, None — если не в формате."""
     match = RESPONSE_RE.search(content)
     if not match:
+        return None
+    return (
+        match.group('title').strip(),
+        split_into_paragraphs(match.group('summary').strip()),
+        match.group('image_prompt').strip(),
+        match.group('tags').strip() if match.group('tags') else '',
+    )
+
+
+@tracing.traced('ai.process_article')
+def process_article(title, text):
+    """Возвращает (заголовок_ru, выжимка_ru, промпт_для_картинки_en, теги_ru).
+    При любой ошибке — ('', '', '', ''), чтобы вызывающий код просто пропустил
+    статью, а не упал. Повторный запрос по той же статье отвечается из кэша
+    без обращения к OpenRouter."""
+    if not text:
+        return '', '', '', ''
+
+    key = _cache_key(title, text)
+    return _cache_get(key) or _process_uncached(title, text, key)
+
+
+def _process_uncached(title, text, key):
+    content = _complete(PROMPT.format(title=title, text=text), max_tokens=500,
+                        validate=lambda c: _parse(c) is not None, end=_single_end)
+    if not content:
+        return '', '', '', ''
+
+    result = _parse(content)
+    if not result:
         # Раньше здесь публиковался content как есть "лишь бы не терять
         # статью" — но вживую это пропустило в канал деградировавший ответ
         # модели (повторяющиеся <unk> и мусорные токены). Пропуск статьи —
@@ -114,9 +472,89 @@ def process_article(title, text):
         logger.warning(f"Ответ модели не в ожидаемом формате, пропускаю статью: {content[:200]!r}")
         return '', '', '', ''
 
-    return (
-        match.group('title').strip(),
-        split_into_paragraphs(match.group('summary').strip()),
-        match.group('image_prompt').strip(),
-        match.group('tags').strip() if match.group('tags') else '',
-    )
+    _cache_put(key, result)
+    return result
+
+
+def _split_batch(content):
+    """Режет пакетный ответ на блоки по заголовкам «### Статья N»:
+    номер -> текст блока. Блоки с чужими или повторными номерами
+    отбрасываются — лучше переспросить статью, чем перепутать выжимки."""
+    markers = list(BATCH_SECTION_RE.finditer(content))
+    blocks = {}
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(content)
+        number = int(marker.group(1))
+        if number in blocks:
+            blocks[number] = None
+        else:
+            blocks[number] = content[marker.end():end]
+    return blocks
+
+
+def _batch_parses(content):
+    # Пакетный ответ засчитывается, если разобрался хоть один раздел:
+    # остальные статьи process_batch переспросит сам.
+    return any(_parse(block) for block in _split_batch(content).values() if block)
+
+
+@tracing.traced('ai.process_batch')
+def process_batch(articles, retries=1):
+    """Пакетный вариант process_article: articles — список (заголовок, текст),
+    ответ — список кортежей в том же порядке. Все статьи, которых нет в кэше,
+    уходят одним запросом с пронумерованными разделами, так что N статей
+    стоят одного запроса из дневной квоты, а не N. Блоки ответа разбираются
+    по отдельности: хорошие сохраняются, а не разобранные (или пропущенные
+    моделью) статьи переспрашиваются ещё раз, уже без хороших."""
+    results = [('', '', '', '')] * len(articles)
+    pending = []
+    for i, (title, text) in enumerate(articles):
+        if not text:
+            continue
+        key = _cache_key(title, text)
+        cached = _cache_get(key)
+        if cached:
+            results[i] = cached
+        else:
+            pending.append((i, key))
+
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if len(pending) == 1:
+            i, key = pending[0]
+            # Одиночная статья — обычный запрос: пакетный формат ей ни к чему.
+            results[i] = _process_uncached(*articles[i], key)
+            break
+
+        sections = '\n\n'.join(
+            BATCH_ARTICLE.format(number=n, title=articles[i][0], text=articles[i][1])
+            for n, (i, _) in enumerate(pending, start=1)
+        )
+        content = _complete(BATCH_PROMPT.format(count=len(pending), articles=sections),
+                            max_tokens=500 * len(pending), validate=_batch_parses,
+                            end=_batch_end(len(pending)))
+        blocks = _split_batch(content) if content else {}
+
+        malformed = []
+        for n, (i, key) in enumerate(pending, start=1):
+            result = _parse(blocks[n]) if blocks.get(n) else None
+            # Внутри пакета «Картинка:» тянется до конца блока — отрезаем
+            # всё после первой строки (разделители, пустые строки). Пустое
+            # поле — блок не в формате, переспрашиваем.
+            image_prompt = (result[2].splitlines() or [''])[0].strip() if result else ''
+            if not image_prompt:
+                malformed.append((i, key))
+                continue
+            title_ru, summary_ru, _, tags_ru = result
+            result = (title_ru, summary_ru, image_prompt, tags_ru)
+            _cache_put(key, result)
+            results[i] = result
+
+        if malformed and attempt < retries:
+            logger.warning(f"Пакетный ответ: не разобрано {len(malformed)} из {len(pending)} статей, переспрашиваю")
+        elif malformed:
+            logger.warning(f"Пакетный ответ: пропускаю {len(malformed)} статей не в ожидаемом формате: {content[:200]!r}")
+        pending = malformed
+
+    return results
@@ -0,0 +1,115 @@
+import hashlib
+import time
+
+from loguru import logger
+
+from database import DATA_DIR, get_state, set_state, delete_state, get_document
+from images import fetch_image
+from seen_index import canonical_url
+import channels
+import ranking
+
+# Бэклог готовых постов: подготовка (лента -> текст -> ИИ -> картинка) идёт
+# заранее, когда есть квота и время, а слот публикации только берёт лучший
+# готовый пост и делает один вызов Telegram. Без него время поста плыло на
+# минуты, а один медленный сервис мог оставить слот пустым.
+#
+# Записи — в документе 'backlog' (data/backlog.json), ключ — канонический
+# URL статьи. Байты картинки — отдельным файлом в BACKLOG_DIR: в JSON им не
+# место, а в git — тем более (история хранила бы каждую навсегда, см.
+# database.py про SQLite). На эфемерном раннере GitHub Actions каталог
+# переносит между прогонами actions/cache — иначе в слот пришлось бы качать
+# картинку заново, а рендер Pollinations — это до полутора минут. Если кэш
+# потерялся, image() скачивает картинку по image_url.
+BACKLOG_DIR = DATA_DIR / 'backlog'
+# Новость, пролежавшая дольше, — уже не новость.
+BACKLOG_TTL = 24 * 3600
+
+
+def _image_path(key):
+    return BACKLOG_DIR / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.jpg"
+
+
+def items():
+    """Готовые посты: ключ -> запись."""
+    return get_document('backlog')
+
+
+def urls():
+    return {record['url'] for record in items().values()}
+
+
+def add(item):
+    """Кладёт готовый пост из конвейера (см. main.prepare) в бэклог."""
+    key = canonical_url(item['url'])
+    BACKLOG_DIR.mkdir(parents=True, exist_ok=True)
+    _image_path(key).write_bytes(item['image_bytes'])
+    set_state(key, {
+        'url': item['url'],
+        'feed_url': item['feed_url'],
+        'category': item['category'],
+        'title': item['entry'].get('title', ''),
+        'text': item['text'],
+        'published': item['entry'].get('published', ''),
+        'title_ru': item['title_ru'],
+        'summary_ru': item['summary_ru'],
+        'tags_ru': item['tags_ru'],
+        'image_url': item['image_url'],
+        'merit': item['merit'],
+        'prepared_at': int(time.time()),
+    }, doc='backlog')
+    logger.info(f"В бэклог [{item['category']}] {item['title_ru']}")
+    return True
+
+
+def discard(key):
+    delete_state(key, doc='backlog')
+    _image_path(key).unlink(missing_ok=True)
+
+
+def expire():
+    """Выбрасывает протухшие посты и уже опубликованные другим путём во
+    все каналы, которые их берут. Возвращает, сколько готовых постов
+    осталось."""
+    now = time.time()
+    for key, record in items().items():
+        if now - record['prepared_at'] >= BACKLOG_TTL or not channels.pending(record['url'], record['category']):
+            logger.info(f"Из бэклога выброшен (устарел или уже опубликован): {record['url']}")
+            discard(key)
+    # Картинки, оставшиеся от записей, которых больше нет (прерванный прогон).
+    if BACKLOG_DIR.exists():
+        alive = {_image_path(key).name for key in items()}
+        for path in BACKLOG_DIR.iterdir():
+            if path.name not in alive:
+                path.unlink()
+    return len(items())
+
+
+def ordered():
+    """Ключи готовых постов в порядке публикации: по баллу ранжирования на
+    момент подготовки (без штрафа за справедливость) за вычетом штрафа
+    источнику по состоянию на сейчас — он мог дать пост уже после подготовки
+    (см. ranking.source_penalty)."""
+    now = time.time()
+
+    def rank(entry):
+        key, record = entry
+        return -(record.get('merit', 0.0) - ranking.source_penalty(record['feed_url'], now)), -record['prepared_at']
+
+    return [key for key, _ in sorted(items().items(), key=rank)]
+
+
+def image(key):
+    """Байты картинки поста: с диска, а если файла нет (кэш каталога в CI
+    потерялся или устарел) — заново по image_url, и снова на диск: тот же
+    пост может уйти ещё в один канал. None — если не удалось ни так, ни так."""
+    path = _image_path(key)
+    if path.exists():
+        return path.read_bytes()
+    record = get_state(key, default=None, doc='backlog')
+    result = fetch_image([record['image_url']]) if record else None
+    if not result:
+        return None
+    BACKLOG_DIR.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(result[0])
+    return result[0]
@@ -0,0 +1,159 @@
+"""Офлайн-бенчмарк полного прогона main.run.
+
+Каждый сценарий запускается в отдельном процессе (у модулей бота
+глобальное состояние — кэши, пул соединений, счётчики), со своей временной
+data/ и своими заглушками всех внешних сервисов (bench/stubs.py):
+
+    python -m bench                      # все сценарии
+    python -m bench baseline llm_429     # выбранные
+    python -m bench --json report.json   # плюс машиночитаемый отчёт
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+from bench.scenarios import SCENARIOS, build_services
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Стадии таблицы — интервалы tracing.py, которые пишет сам бот.
+STAGE_SPANS = {
+    'feeds': 'feeds.prefetch',
+    'extract': 'extractor.get_article',
+    'summarize': 'ai.process_batch',
+    'image': 'images.fetch_image',
+    'publish': 'publisher.post_news',
+}
+
+
+def _child(name):
+    """Один сценарий в текущем процессе; результат — JSON последней строкой."""
+    from bench.stubs import StubWorld
+
+    scenario = SCENARIOS[name]
+    services = build_services(scenario.get('services', {}))
+    feeds = [
+        (category, source_name)
+        for category, sources in scenario['feeds'].items()
+        for source_name in sources
+    ]
+    world = StubWorld(services, feeds, entries_per_feed=scenario.get('entries_per_feed', 5)).start()
+
+    os.environ.update({
+        'BOT_TOKEN': 'bench', 'CHANNEL_ID': '@bench',
+        'OPENROUTER_API_KEY': 'bench', 'PEXELS_API_KEY': 'bench',
+        'OPENROUTER_API_URL': world.urls['openrouter'] + '/api/v1/chat/completions',
+        'PEXELS_API_URL': world.urls['pexels'] + '/v1/search',
+        'POLLINATIONS_URL': world.urls['pollinations'] + '/prompt/',
+        'TELEGRAM_API_URL': world.urls['telegram'],
+    })
+    os.chdir(tempfile.mkdtemp(prefix=f'bench-{name}-'))
+
+    # Конфиг правим до импорта main: он забирает значения при импорте.
+    import config
+    config.FEEDS = {}
+    for index, (category, source_name) in enumerate(feeds):
+        config.FEEDS.setdefault(category, []).append((source_name, world.feed_url(index)))
+    for key, value in scenario.get('config', {}).items():
+        setattr(config, key, value)
+    config.HTTP_TIMEOUTS[urlsplit(world.urls['pollinations']).hostname] = 90
+
+    import main
+    import database
+    import feeds as feeds_module
+    import tracing
+
+    if scenario.get('stale'):
+        # «Ничего нового»: кэш лент прогрет, все статьи уже опубликованы.
+        database.init_db()
+        feeds_module.prefetch([world.feed_url(i) for i in range(len(feeds))], world.entries_per_feed)
+        for url in world.article_urls():
+            database.add_news('', '', '', url, '', '')
+        if not scenario.get('quiet'):
+            # Предзагрузка уже дала health.py оценку частоты лент, и прогон
+            # сразу после неё не опросил бы ни одной (feeds.quiet) — а
+            # сценарий меряет условный GET. Адаптивный пропуск — в 'quiet'.
+            for i in range(len(feeds)):
+                database.delete_state(world.feed_url(i), doc='feed_stats')
+        database.flush()
+        for service in services.values():
+            service.requests = service.failures = service.bytes_in = service.bytes_out = 0
+
+    started = time.monotonic()
+    main.run()
+    wall = time.monotonic() - started
+    world.stop()
+
+    stubs = world.stats()
+    spans = tracing.report()['spans']
+    empty = {'count': 0, 'p50': 0.0, 'p90': 0.0, 'max': 0.0}
+    return {
+        'scenario': name,
+        'wall': wall,
+        'posted': stubs['telegram']['requests'],
+        'stages': {stage: spans.get(span, empty) for stage, span in STAGE_SPANS.items()},
+        'counters': tracing.report()['counters'],
+        'bytes_in': sum(s['bytes_out'] for s in stubs.values()),
+        'bytes_out': sum(s['bytes_in'] for s in stubs.values()),
+        'services': stubs,
+    }
+
+
+def _run_scenario(name, verbose):
+    process = subprocess.run(
+        [sys.executable, '-m', 'bench', '--child', name],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=None if verbose else subprocess.DEVNULL, text=True,
+    )
+    if process.returncode != 0:
+        return {'scenario': name, 'error': f'код выхода {process.returncode}'}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def _print_table(results):
+    stages = tuple(STAGE_SPANS)
+    header = f"{'сценарий':<24}{'время, с':>9}{'постов':>8}{'КБ вход':>10}{'КБ выход':>10}  " + \
+        '  '.join(f'{stage} p50/p90' for stage in stages)
+    print(header)
+    for result in results:
+        if 'error' in result:
+            print(f"{result['scenario']:<24}ошибка: {result['error']}")
+            continue
+        cells = '  '.join(
+            f"{result['stages'][stage]['p50']:>6.2f}/{result['stages'][stage]['p90']:<6.2f}".ljust(len(stage) + 8)
+            for stage in stages
+        )
+        print(f"{result['scenario']:<24}{result['wall']:>9.2f}{result['posted']:>8}"
+              f"{result['bytes_in'] / 1024:>10.0f}{result['bytes_out'] / 1024:>10.0f}  {cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', help=f"из: {', '.join(SCENARIOS)}")
+    parser.add_argument('--json', help='куда записать отчёт в JSON')
+    parser.add_argument('--verbose', action='store_true', help='показывать логи бота')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(_child(args.child)))
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    results = [_run_scenario(name, args.verbose) for name in names]
+    _print_table(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+from bench.stubs import Service
+
+# Те же пять категорий и 22 ленты, что в config.FEEDS, — нагрузка на
+# предзагрузку и ранжирование как в проде.
+FEEDS = {
+    'ИИ': [f'ИИ {i}' for i in range(5)],
+    'Робототехника': [f'Робототехника {i}' for i in range(2)],
+    'Наука': [f'Наука {i}' for i in range(4)],
+    'Программирование': [f'Программирование {i}' for i in range(4)],
+    'ИТ': [f'ИТ {i}' for i in range(7)],
+}
+
+# Задержки по умолчанию — порядок величин, замеченный на живых прогонах:
+# OpenRouter на бесплатной модели отвечает секунды, остальное — десятые.
+DEFAULT_SERVICES = {
+    'feeds': {'latency': 0.2, 'jitter': 0.3},
+    'articles': {'latency': 0.3, 'jitter': 0.2, 'payload_size': 80000},
+    'images': {'latency': 0.2, 'jitter': 0.1, 'payload_size': 300000},
+    'pollinations': {'latency': 5.0, 'jitter': 2.0, 'payload_size': 150000},
+    'pexels': {'latency': 0.2, 'payload_size': 1},
+    'openrouter': {'latency': 1.0, 'jitter': 0.5, 'chunk_delay': 0.05},
+    'telegram': {'latency': 0.3, 'jitter': 0.1},
+}
+
+
+def channel(chat_id='@bench', categories=None, per_run=1, seen=None):
+    """Канал для config.CHANNELS; слоты — каждый час, чтобы прогон бенчмарка
+    в любое время попадал в слот."""
+    return {'chat_id': chat_id, 'categories': categories, 'per_run': per_run,
+            'slots': tuple(range(24)), 'seen': seen}
+
+
+def build_services(overrides):
+    return {
+        name: Service(**{**params, **overrides.get(name, {})})
+        for name, params in DEFAULT_SERVICES.items()
+    }
+
+
+SCENARIOS = {
+    # Всё работает, квота прогона как в проде.
+    'baseline': {'feeds': FEEDS},
+    # Квота побольше — видно, как конвейер и пакеты ИИ держат время.
+    'quota_5': {'feeds': FEEDS, 'config': {'CHANNELS': [channel(per_run=5)]}},
+    # Второй канал только про ИИ и роботов: ленты, тексты и ИИ — общие,
+    # сверху — только его вызовы Telegram.
+    'two_channels': {
+        'feeds': FEEDS,
+        'config': {'CHANNELS': [channel(per_run=2), channel('@bench_ai', ('ИИ', 'Робототехника'), 2, 'ai')]},
+    },
+    # Нового нет нигде: весь прогон — проверка 22 лент.
+    'all_feeds_stale': {'feeds': FEEDS, 'stale': True},
+    # Нового нет, и ленты только что опрошены: адаптивный опрос (health.py)
+    # не качает ни одной, записи — из кэша.
+    'all_feeds_quiet': {'feeds': FEEDS, 'stale': True, 'quiet': True},
+    # og:image битые, Pexels пуст — каждую картинку рисует медленный генератор.
+    'slow_image_generator': {
+        'feeds': FEEDS,
+        'services': {
+            'images': {'failure_rate': 1.0, 'failure_status': 404},
+            'pexels': {'payload_size': 0},
+            'pollinations': {'latency': 20.0, 'jitter': 5.0},
+        },
+    },
+    # Бесплатный пул OpenRouter перегружен: половина запросов — 429.
+    'llm_429': {
+        'feeds': FEEDS,
+        'services': {'openrouter': {'failure_rate': 0.5, 'failure_status': 429, 'retry_after': 1}},
+    },
+    # Модель то и дело вырождается в <unk> посреди ответа.
+    'llm_degenerate': {
+        'feeds': FEEDS,
+        'services': {'openrouter': {'garbage_rate': 0.5}},
+    },
+    # Тяжёлые страницы статей (по 3 МБ) на медленном хосте.
+    'heavy_pages': {
+        'feeds': FEEDS,
+        'services': {'articles': {'latency': 0.5, 'payload_size': 3_000_000}},
+    },
+}
@@ -0,0 +1,293 @@
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from PIL import Image
+
+# Локальные заглушки всех внешних сервисов бота. У каждой — своя задержка,
+# доля отказов и размер ответа (см. Service), и каждая считает запросы и
+# байты в обе стороны. Каждая заглушка слушает свой адрес 127.0.0.x, чтобы
+# http_client видел их как разные хосты — как и в проде.
+
+WORDS = (
+    'robot model data science energy quantum network chip battery sensor '
+    'galaxy protein climate fusion drone satellite vaccine algorithm cloud '
+    'compiler kernel browser privacy startup funding launch research study '
+    'ocean genome laser material reactor vision language agent benchmark'
+).split()
+
+
+class Service:
+    """Поведение одной заглушки: задержка (базовая + равномерный разброс),
+    доля отказов и каким статусом отказывать, размер полезной нагрузки.
+    Для потоковых ответов (SSE) — пауза между кусками и доля ответов,
+    которые вырождаются в мусор посреди генерации."""
+
+    def __init__(self, latency=0.05, jitter=0.0, failure_rate=0.0, failure_status=500,
+                 retry_after=None, payload_size=None, chunk_delay=0.0, garbage_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.retry_after = retry_after
+        self.payload_size = payload_size
+        self.chunk_delay = chunk_delay
+        self.garbage_rate = garbage_rate
+        self.requests = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    def delay(self):
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def should_fail(self):
+        return random.random() < self.failure_rate
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None
+    app = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # Бот обрывает соединения сам (поток ИИ, проигравшая картинка) —
+        # это не ошибка заглушки.
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    def _handle(self):
+        service = self.service
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        with service.lock:
+            service.requests += 1
+            service.bytes_in += length
+        service.delay()
+        if service.should_fail():
+            with service.lock:
+                service.failures += 1
+            headers = {}
+            if service.retry_after is not None:
+                headers['Retry-After'] = str(service.retry_after)
+            return self._send(service.failure_status, b'{"error": "stub failure"}', 'application/json', headers)
+        return self.app(self, body)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def _stream(self, chunks):
+        # Ответ без Content-Length, до закрытия соединения — как SSE у
+        # OpenRouter; клиент может оборвать чтение в любой момент.
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                time.sleep(self.service.chunk_delay)
+                self.wfile.write(chunk)
+                self.wfile.flush()
+                with self.service.lock:
+                    self.service.bytes_out += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send(self, status, payload, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+        with self.service.lock:
+            self.service.bytes_out += len(payload)
+
+
+def _serve(address, service, app):
+    handler = type('Handler', (_Handler,), {'service': service, 'app': staticmethod(app)})
+    try:
+        server = ThreadingHTTPServer((address, 0), handler)
+    except OSError:
+        # Не на Linux 127.0.0.x, кроме .1, может не подниматься.
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f'http://{host}:{port}'
+
+
+class StubWorld:
+    """Поднимает все заглушки сразу и знает их адреса.
+
+    feeds — список (категория, имя) лент; у каждой entries_per_feed записей
+    со ссылками на страницы заглушки статей. Ленты отдают ETag и отвечают
+    304 на If-None-Match — как настоящие, не менявшиеся с прошлого раза."""
+
+    def __init__(self, services, feeds, entries_per_feed=5, seed=1):
+        self.services = services
+        self.feeds = feeds
+        self.entries_per_feed = entries_per_feed
+        self.seed = seed
+        self.servers = []
+        self.urls = {}
+
+    def start(self):
+        apps = {
+            'feeds': self._feed_app,
+            'articles': self._article_app,
+            'images': self._image_app,
+            'pollinations': self._image_app,
+            'pexels': self._pexels_app,
+            'openrouter': self._openrouter_app,
+            'telegram': self._telegram_app,
+        }
+        for i, (name, app) in enumerate(apps.items(), start=2):
+            server, url = _serve(f'127.0.0.{i}', self.services[name], app)
+            self.servers.append(server)
+            self.urls[name] = url
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def feed_url(self, index):
+        return f"{self.urls['feeds']}/feed/{index}.xml"
+
+    def article_urls(self):
+        return [
+            f"{self.urls['articles']}/article/{feed}/{entry}"
+            for feed in range(len(self.feeds))
+            for entry in range(self.entries_per_feed)
+        ]
+
+    def stats(self):
+        return {name: service.stats() for name, service in self.services.items()}
+
+    # --- приложения заглушек ---
+
+    def _feed_app(self, handler, body):
+        match = re.match(r'/feed/(\d+)\.xml', urlsplit(handler.path).path)
+        if not match:
+            return handler._send(404, b'', 'text/plain')
+        index = int(match.group(1))
+        etag = f'"feed-{index}"'
+        if handler.headers.get('If-None-Match') == etag:
+            return handler._send(304, b'', 'application/rss+xml', {'ETag': etag})
+        rng = random.Random(f'{self.seed}-feed-{index}')
+        items = []
+        for entry in range(self.entries_per_feed):
+            link = f"{self.urls['articles']}/article/{index}/{entry}"
+            items.append(
+                f'<item><title>{_words(rng, 8)}</title><link>{link}</link>'
+                f'<description>{_words(rng, 40)}</description>'
+                f'<pubDate>Mon, 01 Jan 2024 {entry:02d}:00:00 GMT</pubDate></item>'
+            )
+        payload = (
+            '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+            f'<title>{self.feeds[index][1]}</title>{"".join(items)}</channel></rss>'
+        ).encode('utf-8')
+        return handler._send(200, payload, 'application/rss+xml; charset=utf-8', {'ETag': etag})
+
+    def _article_app(self, handler, body):
+        rng = random.Random(f'{self.seed}-{handler.path}')
+        size = self.services['articles'].payload_size or 60000
+        paragraphs = []
+        total = 0
+        while total < size:
+            paragraph = f'<p>{_words(rng, 60)}.</p>\n'
+            paragraphs.append(paragraph)
+            total += len(paragraph)
+        image = f"{self.urls['images']}/og{handler.path}.jpg"
+        payload = (
+            f'<html><head><title>{_words(rng, 6)}</title>'
+            f'<meta property="og:image" content="{image}"></head>'
+            f'<body><article><h1>{_words(rng, 6)}</h1>{"".join(paragraphs)}</article></body></html>'
+        ).encode('utf-8')
+        return handler._send(200, payload, 'text/html; charset=utf-8')
+
+    def _image_app(self, handler, body):
+        size = handler.service.payload_size or 200000
+        # Настоящий JPEG 1920x1080 (бот его декодирует и ужимает, см.
+        # images.normalize), дополненный до нужного размера: байты после
+        # маркера конца JPEG декодеры пропускают. Цвет зависит от пути —
+        # одна и та же ссылка отдаёт одни и те же байты.
+        color = tuple(random.Random(handler.path).randrange(256) for _ in range(3))
+        buffer = io.BytesIO()
+        Image.new('RGB', (1920, 1080), color).save(buffer, 'JPEG')
+        payload = buffer.getvalue()
+        payload += bytes(max(0, size - len(payload)))
+        return handler._send(200, payload, 'image/jpeg')
+
+    def _pexels_app(self, handler, body):
+        count = self.services['pexels'].payload_size
+        photos = [
+            {'id': i, 'src': {'large': f"{self.urls['images']}/pexels/{i}.jpg"}}
+            for i in range(1 if count is None else count)
+        ]
+        return handler._send(200, json.dumps({'photos': photos}).encode('utf-8'), 'application/json')
+
+    def _openrouter_app(self, handler, body):
+        request = json.loads(body or b'{}')
+        prompt = request.get('messages', [{}])[-1].get('content', '')
+        count = len(re.findall(r'^### Статья \d+', prompt, re.MULTILINE))
+        rng = random.Random(prompt)
+
+        def block():
+            return (
+                f"Заголовок: {_words(rng, 6)}\n"
+                f"Текст: {_words(rng, 20)}. {_words(rng, 20)}.\n"
+                f"Теги: наука, технологии\n"
+                f"Картинка: {_words(rng, 6)}\n"
+            )
+
+        if count:
+            content = '\n'.join(f'### Статья {n}\n{block()}' for n in range(1, count + 1))
+        else:
+            content = block()
+        if request.get('stream'):
+            service = self.services['openrouter']
+            if random.random() < service.garbage_rate:
+                content = 'Заголовок: ' + '<unk> ' * 400
+            pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+            events = [
+                b': OPENROUTER PROCESSING\n\n',
+                *(f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]}, ensure_ascii=False)}\n\n"
+                  .encode('utf-8') for piece in pieces),
+                b'data: [DONE]\n\n',
+            ]
+            return handler._stream(events)
+        payload = {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+        return handler._send(200, json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    def _telegram_app(self, handler, body):
+        payload = {'ok': True, 'result': {'message_id': self.services['telegram'].requests,
+                                          'photo': [{'file_id': f'stub-{len(body)}'}]}}
+        return handler._send(200, json.dumps(payload).encode('utf-8'), 'application/json')
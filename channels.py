@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+
+from config import CHANNELS
+from database import get_state, set_state, is_known
+
+# Маршрутизация по каналам (config.CHANNELS). Раньше второй канал означал
+# вторую копию бота целиком: те же ленты, те же страницы и второй счёт в
+# OpenRouter за те же выжимки. Теперь подготовка (main.prepare) одна на все
+# каналы и кладёт посты в общий бэклог, а публикация раздаёт каждый пост
+# всем каналам, которые берут его категорию и ещё его не публиковали. У
+# каждого канала — своя квота на слот, свои слоты и свой индекс
+# опубликованного (database.is_known с seen=...).
+#
+# Какие слоты каналов уже отработаны — в ключе состояния 'channel_slots':
+# chat_id -> время (unix) последнего отработанного слота. Так повторный
+# запуск cron в тот же слот не публикует второй раз, а канал, у которого
+# слот был пропущен (раннер опоздал), отработает его при следующем запуске.
+
+
+def wants(channel, category):
+    return channel['categories'] is None or category in channel['categories']
+
+
+def pending(url, category, channels=None):
+    """Каналы, которые берут статью этой категории и ещё её не публиковали."""
+    return [
+        channel for channel in (CHANNELS if channels is None else channels)
+        if wants(channel, category) and not is_known(url, channel['seen'])
+    ]
+
+
+def last_slot(channel, now):
+    """Начало последнего слота канала не позже now (datetime в UTC)."""
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    for day in (hour, hour - timedelta(days=1)):
+        for slot_hour in sorted(channel['slots'], reverse=True):
+            slot = day.replace(hour=slot_hour)
+            if slot <= now:
+                return slot
+
+
+def next_slot(channel, now):
+    """Начало следующего слота канала после now."""
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    for day in (hour, hour + timedelta(days=1)):
+        for slot_hour in sorted(channel['slots']):
+            slot = day.replace(hour=slot_hour)
+            if slot > now:
+                return slot
+
+
+def due(now=None):
+    """Каналы, чей последний слот ещё не отработан."""
+    now = datetime.now(timezone.utc) if now is None else now
+    served = get_state('channel_slots', default={})
+    return [
+        channel for channel in CHANNELS
+        if served.get(channel['chat_id'], 0) < last_slot(channel, now).timestamp()
+    ]
+
+
+def mark_served(channels, now=None):
+    now = datetime.now(timezone.utc) if now is None else now
+    served = dict(get_state('channel_slots', default={}))
+    for channel in channels:
+        served[channel['chat_id']] = int(last_slot(channel, now).timestamp())
+    set_state('channel_slots', served)
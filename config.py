@@ -5,23 +5,105 @@ CHANNEL_ID = config('CHANNEL_ID')
 OPENROUTER_API_KEY = config('OPENROUTER_API_KEY')
 PEXELS_API_KEY = config('PEXELS_API_KEY')
 
-# Бесплатная модель на OpenRouter. Список бесплатных моделей меняется —
-# актуальный смотреть на https://openrouter.ai/models?max_price=0
-# gemma-4-31b-it временно недоступна (общий бесплатный пул Google AI Studio
-# был перегружен на момент проверки, отдавал 429 всем без исключения) —
+# Адреса внешних сервисов. В проде их никто не трогает — переопределяются
+# через окружение только в бенчмарке (bench/), который поднимает локальные
+# заглушки вместо OpenRouter, Pexels, Pollinations и Telegram.
+OPENROUTER_API_URL = config('OPENROUTER_API_URL', default='https://openrouter.ai/api/v1/chat/completions')
+PEXELS_API_URL = config('PEXELS_API_URL', default='https://api.pexels.com/v1/search')
+POLLINATIONS_URL = config('POLLINATIONS_URL', default='https://image.pollinations.ai/prompt/')
+TELEGRAM_API_URL = config('TELEGRAM_API_URL', default='https://api.telegram.org')
+
+# Бесплатные модели на OpenRouter, в порядке предпочтения. Список бесплатных
+# моделей меняется — актуальный смотреть на
+# https://openrouter.ai/models?max_price=0
+# Бесплатные пулы регулярно отдают 429 всем подряд (так на момент проверки
+# было с gemma-4-31b-it — общий пул Google AI Studio был перегружен) или
+# отвечают очень медленно, поэтому моделей несколько: если первая молчит
+# дольше ai.HEDGE_DELAY или отвечает 429/5xx, запрос уходит следующей (см.
+# ai._complete). Порядок — только начальный: дальше его подстраивает
+# статистика задержек и успехов моделей в data/llm_models.json.
 # nemotron прошла живую проверку.
-OPENROUTER_MODEL = 'nvidia/nemotron-3-super-120b-a12b:free'
+OPENROUTER_MODELS = [
+    'nvidia/nemotron-3-super-120b-a12b:free',
+    'google/gemma-4-31b-it:free',
+    'meta-llama/llama-3.3-70b-instruct:free',
+]
 
 # Лимит на прогон: 8 прогонов (см. cron в workflow) x 1 новость = до 8
-# постов/сутки, равномерно в дневные часы. Round-robin по источникам (main.py)
-# распределяет квоту по кругу, так что за день в канал попадают разные
-# источники, а не всегда первый Habr.
+# постов/сутки, равномерно в дневные часы. Штраф за справедливость в
+# ранжировании (ranking.py) опускает источник, недавно давший пост, так что
+# за день в канал попадают разные источники, а не всегда первый Habr.
 #
 # MAX_ARTICLES_PER_RUN ограничивает и дневную квоту OpenRouter: без оплаченных
 # кредитов она обычно около 50/сутки (см. свой dashboard после регистрации),
 # 8x1 = до 8 запросов/сутки — с большим запасом.
 MAX_ARTICLES_PER_RUN = 1
-MAX_ARTICLES_PER_FEED = 2
+# Сколько последних записей каждой ленты видит ранжирование (ranking.py).
+# Запросов к ИИ это не добавляет: в конвейер идут только лучшие по
+# локальному баллу, а он считается по заголовку и анонсу из RSS.
+MAX_ARTICLES_PER_FEED = 10
+# Множитель балла источника при ранжировании, по умолчанию 1.0. Общие ленты
+# с большим потоком не по теме канала чуть приглушены.
+SOURCE_WEIGHTS = {
+    'Dev.to': 0.8,
+    'TechCrunch': 0.9,
+    'Phys.org': 0.9,
+}
+# Сколько статей сверх оставшейся квоты конвейер (pipeline.py) может держать
+# в работе после извлечения текста: пока одна ждёт картинку, следующая уже
+# идёт в ИИ. Каждая такая статья — запрос к OpenRouter, который может не
+# понадобиться, поэтому запас минимальный.
+PIPELINE_LOOKAHEAD = 1
+# До скольких статей отправлять в OpenRouter одним запросом (ai.process_batch).
+# Реальный размер пакета ограничен ещё и MAX_ARTICLES_PER_RUN +
+# PIPELINE_LOOKAHEAD: больше статей одновременно в работе не бывает.
+LLM_BATCH_SIZE = 3
+
+# Сколько готовых постов держать в бэклоге (backlog.py): слот публикует из
+# него, а подготовка пополняет его до этого размера. Запас в один-два поста
+# сверх квоты слота: если в слот что-то отвалилось, следующий не пуст.
+BACKLOG_SIZE = 3
+
+# Слоты публикации, часы UTC, — те же, что в cron воркфлоу
+# (.github/workflows/post_news.yml). По ним же публикует режим демона
+# (python main.py --daemon), а между слотами раз в DAEMON_POLL_INTERVAL
+# секунд опрашивает ленты, чтобы к слоту кэш лент был свежим.
+POST_SLOTS_UTC = (5, 7, 9, 11, 13, 15, 17, 19)
+DAEMON_POLL_INTERVAL = 20 * 60
+
+# Каналы, в которые публикует бот. Ленты, извлечение текста и ИИ — один
+# проход на все каналы (см. channels.py): готовые посты общие, и канал
+# сверх первого стоит только своих вызовов Telegram. У канала:
+#   categories — какие категории FEEDS он берёт (None — все);
+#   per_run — сколько постов за слот;
+#   slots — часы публикации UTC (cron воркфлоу должен покрывать их все);
+#   seen — имя его индекса опубликованного, data/seen-<seen>.idx; у
+#          основного канала None — это data/seen.idx.
+CHANNELS = [
+    {'chat_id': CHANNEL_ID, 'categories': None, 'per_run': MAX_ARTICLES_PER_RUN,
+     'slots': POST_SLOTS_UTC, 'seen': None},
+    # {'chat_id': '@my_ai_channel', 'categories': ('ИИ', 'Робототехника'), 'per_run': 1,
+    #  'slots': (6, 12, 18), 'seen': 'ai'},
+]
+
+# Лимиты внешних сервисов для планировщика (ratelimit.py): запросов в
+# минуту и в сутки (сутки — по UTC). OpenRouter без оплаченных кредитов —
+# 20 запросов в минуту и около 50 в сутки на бесплатных моделях. Telegram —
+# около 20 сообщений в минуту в один канал, лимит считается на каждый чат.
+RATE_LIMITS = {
+    'openrouter': {'per_minute': 20, 'per_day': 50},
+    'telegram': {'per_minute': 20},
+}
+
+# Таймауты HTTP по хостам, секунды (http_client.py), для остальных — 30.
+# Pollinations рисует картинку по запросу, это занимает до минуты с лишним;
+# OpenRouter на бесплатных моделях тоже бывает медленным.
+HTTP_TIMEOUTS = {
+    'openrouter.ai': 60,
+    'api.telegram.org': 30,
+    'api.pexels.com': 20,
+    'image.pollinations.ai': 90,
+}
 
 # category -> [(человекочитаемое имя источника, URL RSS-ленты), ...]
 FEEDS = {
@@ -1,76 +1,252 @@
+import heapq
 import json
+import os
+import threading
+import time
 from pathlib import Path
 
-# Память бота между запусками теперь живёт в двух текстовых файлах, а не в
-# бинарнике SQLite. Почему так:
-#   * рантайму нужны только два факта — «этот URL уже постили» и «курсор
-#     round-robin по источникам», никакой транзакционной мощности SQLite
-#     здесь не используется;
+from loguru import logger
+
+from seen_index import SeenIndex
+
+# Память бота между запусками живёт в файлах data/, а не в бинарнике
+# SQLite. Почему так:
+#   * рантайму нужны URL, которые уже постили, и набор служебных
+#     документов (когда источники давали посты, кэши, лимиты, бэклог) —
+#     никакой транзакционной мощности SQLite здесь не используется;
 #   * бинарник news.db в git порождал коммит на каждый пост (~2 КБ блоба),
 #     служебные коммиты «Update news database» и бинарные конфликты при
 #     merge — текстовая история этих проблем не имеет и diff'ится как обычный
 #     код (git остаётся единственным хранилищем памяти бота на эфемерном
 #     раннере GitHub Actions).
+# Исключение — индекс опубликованных URL (см. seen_index.py): текстовый
+# список рос бесконечно и целиком читался в память на старте, а индекс
+# фиксированной ширины растёт на 12 байт за пост и ищется через mmap.
 DATA_DIR = Path('data')
+SEEN_INDEX_FILE = DATA_DIR / 'seen.idx'
+# У каждого канала (config.CHANNELS) — свой индекс опубликованного; основной
+# канал остаётся на seen.idx, остальные — seen-<имя>.idx.
+SEEN_INDEX_PATTERN = 'seen-{}.idx'
+# Старый текстовый список — переносится в индекс один раз и удаляется.
 URLS_FILE = DATA_DIR / 'seen_urls.txt'
+# Ленты отдают записи за дни-недели, так что URL старше года снова не
+# встретится — такие записи выбрасываются при сохранении индекса.
+SEEN_RETENTION_DAYS = 365
 STATE_FILE = DATA_DIR / 'state.json'
-
-# Набор URL держим в памяти на время прогона, файл читаем один раз в init_db.
-_seen_urls = set()
-
-
-def _load_seen_urls():
-    if not URLS_FILE.exists():
-        return set()
-    return {line.strip() for line in URLS_FILE.read_text(encoding='utf-8').splitlines() if line.strip()}
-
-
-def _load_state():
-    if not STATE_FILE.exists():
+# Валидаторы HTTP (ETag / Last-Modified) и короткий список последних записей
+# каждой ленты — для условного GET (см. feeds.get_entries). Отдельный файл,
+# а не state.json: он переписывается почти целиком каждый прогон, и его
+# diff не должен тонуть в паре строк state.json.
+FEED_CACHE_FILE = DATA_DIR / 'feed_cache.json'
+# Статистика и здоровье лент: когда качали, чем кончилось, сколько заняло,
+# состояние предохранителя (см. health.py).
+FEED_STATS_FILE = DATA_DIR / 'feed_stats.json'
+# Кэш ответов ИИ по содержимому статьи (см. ai.process_article).
+LLM_CACHE_FILE = DATA_DIR / 'llm_cache.json'
+# Скользящая статистика моделей OpenRouter: задержка, доля успехов, пауза
+# после 429 (см. ai._models).
+LLM_MODELS_FILE = DATA_DIR / 'llm_models.json'
+# Отпечатки опубликованных историй за последние дни (см. dedup.py).
+NEAR_DUPS_FILE = DATA_DIR / 'near_dups.json'
+# Лимиты OpenRouter и Telegram: расход суточной квоты, ведра токенов и
+# retry_after последнего 429 (см. ratelimit.py).
+RATELIMIT_FILE = DATA_DIR / 'ratelimit.json'
+# Готовые к публикации посты (см. backlog.py); картинки к ним — в data/backlog/.
+BACKLOG_FILE = DATA_DIR / 'backlog.json'
+# file_id уже загруженных в Telegram картинок по хешу байтов (см. publisher.py).
+TG_FILES_FILE = DATA_DIR / 'tg_files.json'
+# Страницы результатов поиска Pexels по нормализованному запросу (см. pexels.py).
+PEXELS_CACHE_FILE = DATA_DIR / 'pexels_cache.json'
+# Журнал изменений текущего прогона: каждая правка состояния дописывается
+# сюда строкой JSON сразу, а сами файлы выше переписываются один раз в
+# flush(). Если прогон упал до flush(), init_db() следующего прогона
+# проиграет журнал поверх последнего сохранённого состояния.
+JOURNAL_FILE = DATA_DIR / 'journal.jsonl'
+
+# Документы состояния: имя -> файл. Всё состояние бота (служебные значения, кэш лент,
+# статистика) читается один раз в init_db и живёт в памяти до flush().
+DOCUMENTS = {
+    'state': STATE_FILE,
+    'feed_cache': FEED_CACHE_FILE,
+    'feed_stats': FEED_STATS_FILE,
+    'llm_cache': LLM_CACHE_FILE,
+    'llm_models': LLM_MODELS_FILE,
+    'near_dups': NEAR_DUPS_FILE,
+    'ratelimit': RATELIMIT_FILE,
+    'backlog': BACKLOG_FILE,
+    'tg_files': TG_FILES_FILE,
+    'pexels_cache': PEXELS_CACHE_FILE,
+}
+
+# Имя индекса опубликованного -> SeenIndex; None — индекс основного канала.
+_seen = {}
+_docs = {}
+_dirty = set()
+# Состояние меняют и потоки предзагрузки лент, и конвейер — правка
+# документа и строка журнала должны идти парой.
+_lock = threading.Lock()
+
+
+def _load_document(path):
+    if not path.exists():
         return {}
     try:
-        return json.loads(STATE_FILE.read_text(encoding='utf-8'))
-    except (json.JSONDecodeError, OSError):
+        return json.loads(path.read_text(encoding='utf-8'))
+    except (json.JSONDecodeError, OSError) as e:
+        # С атомарной записью сюда попадаем только при ручной порче файла —
+        # продолжаем с пустым документом, но не молча.
+        logger.error(f"Файл состояния {path} не читается, начинаю с пустого: {e}")
         return {}
 
 
-def _save_state(state):
-    STATE_FILE.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding='utf-8')
+def _write_atomic(path, data):
+    # Временный файл + fsync + rename: после падения на диске либо старая,
+    # либо новая версия файла, но не обрезанная смесь (раньше файл
+    # переписывался на месте, и сбой посреди записи сбрасывал состояние в {}).
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _replay_journal():
+    replayed = 0
+    for line in JOURNAL_FILE.read_text(encoding='utf-8').splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # Последняя строка могла оборваться вместе с процессом.
+            break
+        doc = _docs.setdefault(record['doc'], {})
+        if record.get('deleted'):
+            doc.pop(record['key'], None)
+        else:
+            doc[record['key']] = record['value']
+        _dirty.add(record['doc'])
+        replayed += 1
+    return replayed
 
 
 def init_db():
-    """Готовит файлы памяти бота: директорию, список URL и файл состояния."""
+    """Готовит память бота: директорию, индекс URL и документы состояния.
+    Если предыдущий прогон оборвался, не дойдя до flush(), — дописывает его
+    изменения из журнала."""
     DATA_DIR.mkdir(exist_ok=True)
-    global _seen_urls
-    _seen_urls = _load_seen_urls()
-    if not STATE_FILE.exists():
-        _save_state({})
-
-
-def get_state(key, default=0):
-    """Читает сервисное значение (например, курсор round-robin по источники)."""
-    return _load_state().get(key, default)
-
-
-def set_state(key, value):
-    """Пишет или обновляет сервисное значение."""
-    state = _load_state()
-    state[key] = value
-    _save_state(state)
-
-
-def is_known(url):
-    """Проверка, публиковали ли уже эту статью."""
-    return url in _seen_urls
-
-
-def add_news(category, title, summary, url, image_url, published_at):
-    """Отмечает статью как опубликованную. False, если url уже был (не
-    плодим дубликатов). Заголовок и остальные поля не храним: для рантайма
-    нужен только URL, архив постов — сам канал в Telegram."""
-    if url in _seen_urls:
-        return False
-    with URLS_FILE.open('a', encoding='utf-8') as f:
-        f.write(url + '\n')
-    _seen_urls.add(url)
-    return True
+    for index in _seen.values():
+        index.close()
+    _seen.clear()
+    if URLS_FILE.exists():
+        _seen_index().migrate_from_text(URLS_FILE)
+
+    _docs.clear()
+    _dirty.clear()
+    for name, path in DOCUMENTS.items():
+        _docs[name] = _load_document(path)
+
+    if JOURNAL_FILE.exists():
+        replayed = _replay_journal()
+        logger.warning(f"Предыдущий прогон не сохранил состояние, восстановлено из журнала: {replayed} изменений")
+        flush()
+
+
+def _seen_index(name=None):
+    # Индексы открываются при первом обращении: каналу, которому в этом
+    # прогоне нечего публиковать, файл не нужен.
+    with _lock:
+        index = _seen.get(name)
+        if index is None:
+            path = SEEN_INDEX_FILE if name is None else DATA_DIR / SEEN_INDEX_PATTERN.format(name)
+            index = _seen[name] = SeenIndex(path)
+            index.open()
+        return index
+
+
+def get_state(key, default=0, doc='state'):
+    """Читает сервисное значение (например, когда источники давали посты).
+    Изменённое на месте значение не сохранится — только через set_state."""
+    with _lock:
+        return _docs.get(doc, {}).get(key, default)
+
+
+def set_state(key, value, doc='state'):
+    """Пишет или обновляет сервисное значение. На диск попадает сразу только
+    строка журнала, сам файл документа — в flush()."""
+    with _lock:
+        _docs.setdefault(doc, {})[key] = value
+        _dirty.add(doc)
+        with JOURNAL_FILE.open('a', encoding='utf-8') as f:
+            f.write(json.dumps({'doc': doc, 'key': key, 'value': value}, ensure_ascii=False) + '\n')
+
+
+def delete_state(key, doc='state'):
+    """Удаляет значение (например, вытесненную запись кэша)."""
+    with _lock:
+        if _docs.get(doc, {}).pop(key, None) is None:
+            return
+        _dirty.add(doc)
+        with JOURNAL_FILE.open('a', encoding='utf-8') as f:
+            f.write(json.dumps({'doc': doc, 'key': key, 'deleted': True}) + '\n')
+
+
+def get_document(doc):
+    """Снимок всего документа — для обхода (вытеснение кэша, отчёты)."""
+    with _lock:
+        return dict(_docs.get(doc, {}))
+
+
+def evict(doc, ttl, max_entries, ts_field='ts', lru_field=None):
+    """Чистит документ-кэш: записи старше ttl секунд (по ts_field; None —
+    без срока) — вон, а сверх max_entries вытесняются самые старые по
+    lru_field (по умолчанию тот же ts_field). Сортировки всего документа
+    нет: пока лимит не превышен, это один проход."""
+    lru_field = lru_field or ts_field
+    now = time.time()
+    with _lock:
+        entries = _docs.get(doc, {})
+        expired = {k for k, v in entries.items() if ttl is not None and now - v[ts_field] >= ttl}
+        overflow = len(entries) - len(expired) - max_entries
+        if overflow > 0:
+            alive = ((v[lru_field], k) for k, v in entries.items() if k not in expired)
+            expired.update(k for _, k in heapq.nsmallest(overflow, alive))
+    for k in expired:
+        delete_state(k, doc=doc)
+
+
+def get_feed_cache(feed_url):
+    """Возвращает закэшированные валидаторы и записи ленты или None."""
+    return get_state(feed_url, default=None, doc='feed_cache')
+
+
+def set_feed_cache(feed_url, value):
+    """Запоминает валидаторы и записи ленты."""
+    set_state(feed_url, value, doc='feed_cache')
+
+
+def flush():
+    """Сохраняет всё состояние прогона: изменённые документы — атомарно,
+    опубликованные URL — вливает в индекс (заодно чистя старые записи).
+    Журнал удаляется последним, когда всё уже надёжно на диске."""
+    with _lock:
+        for name in sorted(_dirty):
+            _write_atomic(DOCUMENTS[name], json.dumps(_docs[name], ensure_ascii=False, indent=2))
+        _dirty.clear()
+        for index in _seen.values():
+            index.flush(retention_days=SEEN_RETENTION_DAYS)
+        JOURNAL_FILE.unlink(missing_ok=True)
+
+
+def is_known(url, seen=None):
+    """Проверка, публиковали ли уже эту статью (seen — имя индекса канала,
+    None — основной). URL сравниваются в канонической форме: utm-метки,
+    http/https и хвостовой слэш не делают статью новой."""
+    return url in _seen_index(seen)
+
+
+def add_news(category, title, summary, url, image_url, published_at, seen=None):
+    """Отмечает статью как опубликованную в канале с индексом seen. False,
+    если url уже был (не плодим дубликатов). Заголовок и остальные поля не
+    храним: для рантайма нужен только URL, архив постов — сам канал в
+    Telegram."""
+    return _seen_index(seen).add(url)
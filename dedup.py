@@ -0,0 +1,194 @@
+import hashlib
+import re
+import threading
+import time
+from collections import defaultdict
+
+from database import get_document, get_state, set_state, delete_state
+from seen_index import canonical_url
+
+# Одна и та же новость за пару часов появляется в TechCrunch, The Verge,
+# Wired и Hacker News под разными URL — is_known такие копии не ловит, и на
+# вторую уходили бы запрос к ИИ и пост. Здесь — индекс «отпечатков»
+# опубликованных историй за последние дни:
+#   * SimHash текста статьи (по тройкам слов) — ловит перепечатки и пресс-
+#     релизы, разошедшиеся почти без правок;
+#   * MinHash нормализованного заголовка — ловит пересказы одной новости
+#     своими словами, где текст разный, а ключевые слова заголовка те же.
+# Оба отпечатка разложены по корзинам LSH, так что поиск — несколько
+# словарных обращений и проверка горстки кандидатов, а не обход окна.
+# У записи — каналы, где история уже вышла: копия из другого источника
+# отсекается, только если её уже видели все каналы, куда она шла бы, а
+# иначе идёт только в те, где истории ещё не было (см. posted_in).
+WINDOW_DAYS = 3
+
+# SimHash: 64 бита, 4 полосы по 16 бит. Тексты с расстоянием Хэмминга <= 3
+# по принципу Дирихле совпадут хотя бы в одной полосе целиком.
+SIMHASH_BANDS = 4
+SIMHASH_MAX_DISTANCE = 3
+# Короткий текст даёт шумный SimHash — не сравниваем то, что почти пусто.
+MIN_SHINGLES = 30
+
+# MinHash заголовка: 16 хэшей, 8 полос по 2 — кандидатами становятся пары с
+# оценкой сходства от ~0.35, а дальше порог проверяется по точному Жаккару.
+MINHASH_PERMUTATIONS = 16
+MINHASH_ROWS = 2
+TITLE_THRESHOLD = 0.6
+MIN_TITLE_TOKENS = 3
+# Грубый стемминг обрезкой: «launches»/«launch», «роботы»/«робот».
+STEM_LENGTH = 6
+
+STOPWORDS = {
+    'the', 'and', 'for', 'with', 'from', 'that', 'this', 'into', 'its', 'are',
+    'was', 'has', 'have', 'will', 'new', 'how', 'why', 'what', 'you', 'your',
+    'about', 'after', 'over', 'now', 'can', 'not', 'but', 'more', 'than',
+    'как', 'для', 'что', 'это', 'или', 'при', 'его', 'она', 'они', 'так',
+    'уже', 'ещё', 'еще', 'все', 'всё', 'над', 'под', 'без', 'про', 'чем',
+}
+
+WORD_RE = re.compile(r'\w+')
+
+_records = {}
+_buckets = defaultdict(set)
+_loaded = False
+# Проверку делает поток извлечения, запоминание — поток публикации.
+_lock = threading.Lock()
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _today():
+    return int(time.time() // 86400)
+
+
+def title_tokens(title):
+    return sorted({
+        word[:STEM_LENGTH] for word in WORD_RE.findall(title.lower())
+        if len(word) > 2 and word not in STOPWORDS
+    })
+
+
+def simhash(text):
+    """64-битный SimHash по тройкам слов; 0 — если текста слишком мало."""
+    words = WORD_RE.findall(text.lower())
+    shingles = {' '.join(words[i:i + 3]) for i in range(len(words) - 2)}
+    if len(shingles) < MIN_SHINGLES:
+        return 0
+    weights = [0] * 64
+    for shingle in shingles:
+        h = _hash64(shingle)
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _minhash(tokens):
+    return [min(_hash64(f'{seed}:{token}') for token in tokens) for seed in range(MINHASH_PERMUTATIONS)]
+
+
+def _bucket_keys(fingerprint, tokens):
+    keys = []
+    if fingerprint:
+        width = 64 // SIMHASH_BANDS
+        for band in range(SIMHASH_BANDS):
+            keys.append(('s', band, fingerprint >> (band * width) & ((1 << width) - 1)))
+    if len(tokens) >= MIN_TITLE_TOKENS:
+        signature = _minhash(tokens)
+        for band in range(0, MINHASH_PERMUTATIONS, MINHASH_ROWS):
+            keys.append(('m', band, tuple(signature[band:band + MINHASH_ROWS])))
+    return keys
+
+
+def _index(key, fingerprint, tokens, day, channels=None):
+    # channels — chat_id каналов, где история уже вышла; None — история
+    # занята для всех (взята в работу в этом прогоне или записана до того,
+    # как каналов стало несколько).
+    _records[key] = {'simhash': fingerprint, 'title': tokens, 'day': day, 'channels': channels}
+    for bucket in _bucket_keys(fingerprint, tokens):
+        _buckets[bucket].add(key)
+
+
+def load():
+    """Строит индекс из data/near_dups.json, выбрасывая истории старше окна.
+    Вызывается после init_db — документы состояния читает именно она."""
+    global _loaded
+    with _lock:
+        _records.clear()
+        _buckets.clear()
+        cutoff = _today() - WINDOW_DAYS
+        for key, record in get_document('near_dups').items():
+            if record['day'] < cutoff:
+                delete_state(key, doc='near_dups')
+                continue
+            _index(key, int(record['simhash'], 16), record['title'], record['day'], record.get('channels'))
+        _loaded = True
+
+
+def _similar(record, fingerprint, tokens):
+    if fingerprint and record['simhash'] and bin(fingerprint ^ record['simhash']).count('1') <= SIMHASH_MAX_DISTANCE:
+        return True
+    if len(tokens) >= MIN_TITLE_TOKENS and len(record['title']) >= MIN_TITLE_TOKENS:
+        a, b = set(tokens), set(record['title'])
+        return len(a & b) / len(a | b) >= TITLE_THRESHOLD
+    return False
+
+
+def _matches(title, text, exclude=None):
+    """Записи индекса, почти совпадающие с историей (кроме ключа exclude)."""
+    if not _loaded:
+        load()
+    fingerprint, tokens = simhash(text), title_tokens(title)
+    with _lock:
+        candidates = set()
+        for bucket in _bucket_keys(fingerprint, tokens):
+            candidates |= _buckets.get(bucket, set())
+        candidates.discard(exclude)
+        return [(key, _records[key]) for key in candidates if _similar(_records[key], fingerprint, tokens)]
+
+
+def find_duplicate(title, text):
+    """Та же история, уже опубликованная или взятая в этот прогон: (URL
+    одной из копий, chat_id каналов, где она уже вышла) — None вместо
+    каналов, если история занята для всех. (None, set()), если копий нет."""
+    duplicate_of, carried = None, set()
+    for key, record in _matches(title, text):
+        duplicate_of = duplicate_of or key
+        if record['channels'] is None:
+            return key, None
+        carried |= set(record['channels'])
+    return duplicate_of, carried
+
+
+def posted_in(url, title, text):
+    """chat_id каналов, где уже вышла другая копия той же истории."""
+    carried = set()
+    for _, record in _matches(title, text, exclude=canonical_url(url)):
+        carried |= set(record['channels'] or ())
+    return carried
+
+
+def claim(url, title, text):
+    """Отмечает историю как взятую в работу в этом прогоне — без записи на
+    диск. Вторая копия той же новости из другой ленты того же прогона не
+    дойдёт до ИИ, даже пока первая ещё в конвейере."""
+    with _lock:
+        _index(canonical_url(url), simhash(text), title_tokens(title), _today())
+
+
+def remember(url, title, text, chat_id):
+    """Запоминает историю, опубликованную в канале chat_id, в
+    data/near_dups.json."""
+    key, fingerprint, tokens = canonical_url(url), simhash(text), title_tokens(title)
+    previous = get_state(key, default=None, doc='near_dups')
+    if previous is None:
+        channels = [chat_id]
+    elif previous.get('channels') is None:
+        channels = None
+    else:
+        channels = sorted(set(previous['channels']) | {chat_id})
+    with _lock:
+        _index(key, fingerprint, tokens, _today(), channels)
+    set_state(key, {'simhash': f'{fingerprint:016x}', 'title': tokens, 'day': _today(), 'channels': channels},
+              doc='near_dups')
@@ -2,17 +2,36 @@ import re
 
 import trafilatura
 from loguru import logger
+from trafilatura.downloads import DEFAULT_HEADERS
+
+import http_client
+import tracing
 
 # Ограничение на входной текст для ИИ — экономит токены и держит запрос
 # в пределах контекста бесплатной модели.
 MAX_CHARS = 4000
 
+# Страницу читаем потоком, а не trafilatura.fetch_url целиком: тяжёлые
+# страницы (Nature, The Verge) весят мегабайты, а нам из них нужно
+# MAX_CHARS символов текста. Потолок на объём — на случай совсем огромных.
+MAX_DOWNLOAD_BYTES = 2 * 1024 * 1024
+CHUNK_SIZE = 32 * 1024
+DOWNLOAD_TIMEOUT = 30
+# Останавливаемся, когда видимого текста в <body> набралось с запасом на
+# меню, подвалы и подписи — trafilatura выбросит их, и MAX_CHARS статьи
+# должно остаться.
+EARLY_STOP_CHARS = MAX_CHARS * 5
+
 # Изолируем сам <meta ...> тег, а не сразу content= — атрибуты в реальном
 # HTML идут в разном порядке (то property перед content, то наоборот).
 OG_IMAGE_TAG_RE = re.compile(
     r'<meta[^>]+(?:property|name)=["\']og:image["\'][^>]*>', re.IGNORECASE
 )
 CONTENT_ATTR_RE = re.compile(r'content=["\']([^"\']+)["\']', re.IGNORECASE)
+HEAD_END_RE = re.compile(r'</head\s*>', re.IGNORECASE)
+# Грубая оценка видимого текста: без скриптов, стилей и тегов. Точность не
+# нужна — только понять, что текста уже заведомо хватает.
+INVISIBLE_RE = re.compile(r'<(script|style|noscript)\b.*?</\1\s*>|<[^>]*>', re.IGNORECASE | re.DOTALL)
 
 
 def _extract_og_image(html):
@@ -23,18 +42,58 @@ def _extract_og_image(html):
     return content_match.group(1) if content_match else ''
 
 
+def _visible_chars(html):
+    return len(' '.join(INVISIBLE_RE.sub(' ', html).split()))
+
+
+def _download(url):
+    """Читает страницу потоком до MAX_DOWNLOAD_BYTES или до момента, когда
+    текста заведомо хватает. Возвращает (байты, og:image): og:image ищется в
+    <head>, как только он докачан, — тело ради неё ждать не нужно."""
+    buffer = bytearray()
+    og_image = ''
+    head_end = None
+    body_chars = 0
+    with http_client.get(url, headers=DEFAULT_HEADERS, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            buffer += chunk
+            if head_end is None:
+                html = buffer.decode('utf-8', errors='ignore')
+                match = HEAD_END_RE.search(html)
+                if match:
+                    head_end = match.end()
+                    og_image = _extract_og_image(html[:head_end])
+                    body_chars = _visible_chars(html[head_end:])
+            else:
+                # Кусок может разрезать тег пополам — оценке это не мешает.
+                body_chars += _visible_chars(chunk.decode('utf-8', errors='ignore'))
+            if body_chars >= EARLY_STOP_CHARS or len(buffer) >= MAX_DOWNLOAD_BYTES:
+                break
+
+    if head_end is None:
+        # Страница без </head> (или оборвалась раньше) — ищем по всему, что есть.
+        og_image = _extract_og_image(buffer.decode('utf-8', errors='ignore'))
+    return bytes(buffer), og_image
+
+
+@tracing.traced('extractor.get_article')
 def get_article(url):
     """Скачивает страницу один раз и возвращает (текст_статьи, og:image).
     RSS редко даёт картинку (проверено вживую на Habr, TechCrunch), а вот
     og:image на самой странице у них почти всегда есть — та же картинка,
     что видна в превью ссылки в мессенджерах."""
     try:
-        downloaded = trafilatura.fetch_url(url)
+        downloaded, image = _download(url)
         if not downloaded:
             return '', ''
-        text = trafilatura.extract(downloaded) or ''
-        image = _extract_og_image(downloaded)
-        return text[:MAX_CHARS], image
+        # trafilatura сама определит кодировку по байтам, а оборванный на
+        # середине HTML lxml достраивает без ошибок.
+        text = (trafilatura.extract(downloaded) or '')[:MAX_CHARS]
+        tracing.incr('bytes.article_downloaded', len(downloaded))
+        tracing.incr('bytes.article_used', len(text.encode('utf-8')))
+        logger.info(f"Статья {url}: скачано {len(downloaded)} байт, в текст пошло {len(text.encode('utf-8'))}")
+        return text, image
     except Exception as e:
         logger.error(f"Ошибка извлечения статьи {url}: {e}")
         return '', ''
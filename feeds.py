@@ -1,21 +1,149 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
 import feedparser
 from loguru import logger
 
+import health
+import http_client
+import tracing
+from database import get_feed_cache, set_feed_cache
+
+# Таймаут одной ленты. feedparser.parse(url) сам качает ленту без таймаута —
+# зависший сервер (бывало с Nature и DeepMind) держал весь прогон, поэтому
+# качаем через общий http_client, а feedparser получает уже готовые байты.
+FETCH_TIMEOUT = 20
+# Лент ~20, все на разных хостах — держать их последовательно незачем:
+# время предзагрузки ≈ самая медленная лента, а не сумма всех.
+PREFETCH_WORKERS = 8
+# Жёсткий потолок на всю предзагрузку: таймаут requests — это таймаут на
+# одну операцию сокета, медленно «капающая» лента может тянуться дольше.
+PREFETCH_TIMEOUT = 45
+# Ленты не повторяем: зависшая лента с повторами http_client (3 попытки по
+# FETCH_TIMEOUT) не уложилась бы в PREFETCH_TIMEOUT, а её поток дописывал бы
+# состояние уже после flush(). Упавшую ленту снова спросит следующий прогон,
+# а совсем мёртвую отключит предохранитель (health.py).
+FETCH_RETRIES = 0
+# Сколько последних записей ленты держим в кэше для ответа 304. Больше,
+# чем MAX_ARTICLES_PER_FEED, с запасом — кэш не должен зависеть от лимита.
+CACHED_ENTRIES = 10
+SUMMARY_CHARS = 500
+
+
+def _compact_entry(entry):
+    """Оставляет от записи feedparser только поля, которые читает main.py,
+    в виде обычного dict — его можно положить в JSON и вернуть из кэша.
+    Картинку кладём в media_content, чтобы entry_image находил её так же,
+    как в настоящей записи."""
+    compact = {
+        'title': entry.get('title', ''),
+        'link': entry.get('link', ''),
+        'published': entry.get('published', ''),
+        'updated': entry.get('updated', ''),
+        'summary': entry.get('summary', '')[:SUMMARY_CHARS],
+    }
+    image = entry_image(entry)
+    if image:
+        compact['media_content'] = [{'url': image}]
+    return compact
 
-def get_entries(feed_url, limit):
+
+@tracing.traced('feeds.get_entries')
+def get_entries(feed_url, limit, timeout=FETCH_TIMEOUT):
     """Забирает последние записи RSS-ленты. При ошибке — пустой список,
-    чтобы одна упавшая лента не останавливала обработку остальных."""
+    чтобы одна упавшая лента не останавливала обработку остальных.
+
+    Запрос условный: если лента с прошлого прогона не менялась, сервер
+    отвечает 304 без тела, и мы отдаём записи из кэша, ничего не разбирая
+    (новых среди них нет — main.py отсеет уже опубликованные через is_known).
+    feedparser умеет etag/modified сам, но мы качаем ленту через requests
+    (см. FETCH_TIMEOUT), поэтому заголовки ставим сами."""
+    cached = get_feed_cache(feed_url) or {}
+    headers = {'User-Agent': feedparser.USER_AGENT}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('modified'):
+        headers['If-Modified-Since'] = cached['modified']
+
+    started = time.monotonic()
+
+    def record(status, entries=0, bozo=False):
+        tracing.incr(f'feeds.{status}')
+        health.record(feed_url, status, time.monotonic() - started, entries, bozo)
+
     try:
-        parsed = feedparser.parse(feed_url)
+        response = http_client.get(feed_url, headers=headers, timeout=timeout, retries=FETCH_RETRIES)
+        if response.status_code == 304:
+            entries = cached.get('entries', [])
+            record('not_modified', len(entries))
+            health.observe(feed_url, [entry_time(entry) for entry in entries])
+            return entries[:limit]
+        response.raise_for_status()
+        tracing.incr('bytes.feeds', len(response.content))
+        # Заголовки ответа нужны feedparser'у, чтобы правильно определить
+        # кодировку — раньше он видел их сам, когда качал ленту по URL.
+        parsed = feedparser.parse(response.content, response_headers=dict(response.headers))
     except Exception as e:
         logger.error(f"Не удалось загрузить ленту {feed_url}: {e}")
+        record('error')
         return []
 
     if parsed.bozo and not parsed.entries:
         logger.warning(f"Лента повреждена или недоступна {feed_url}: {parsed.get('bozo_exception')}")
+        record('broken', bozo=True)
         return []
 
-    return parsed.entries[:limit]
+    entries = [_compact_entry(entry) for entry in parsed.entries[:CACHED_ENTRIES]]
+    # Записи кэшируем и без валидаторов: условного GET не будет, но ленту,
+    # которую пропускает адаптивный опрос (см. prefetch), ранжирование
+    # всё равно видит. Заголовки условного запроса ставятся, только если
+    # валидаторы есть.
+    set_feed_cache(feed_url, {
+        'etag': response.headers.get('ETag', ''),
+        'modified': response.headers.get('Last-Modified', ''),
+        'entries': entries,
+    })
+    record('ok', len(entries), bool(parsed.bozo))
+    health.observe(feed_url, [entry_time(entry) for entry in entries])
+    return entries[:limit]
+
+
+@tracing.traced('feeds.prefetch')
+def prefetch(feed_urls, limit):
+    """Загружает и разбирает все ленты параллельно. Возвращает словарь
+    url -> записи в том же порядке, что и feed_urls; лента, не успевшая за
+    PREFETCH_TIMEOUT, получает пустой список, как и упавшая. Ленты с
+    разомкнутым предохранителем (см. health.py) не запрашиваются вовсе, а
+    ленты, где новое маловероятно (см. health.worth_polling), — тоже, и
+    получают записи из кэша: ранжированию они нужны как корпус, а
+    не выбранные раньше записи ещё могут пойти в дело."""
+    results = {}
+    skipped = [url for url in feed_urls if not health.allow(url)]
+    if skipped:
+        tracing.incr('feeds.circuit_open', len(skipped))
+        logger.info(f"Пропускаю ленты с разомкнутым предохранителем: {', '.join(skipped)}")
+    quiet = [url for url in feed_urls if url not in skipped and not health.worth_polling(url)]
+    if quiet:
+        tracing.incr('feeds.quiet', len(quiet))
+        logger.info(f"Новое маловероятно, беру из кэша: {', '.join(quiet)}")
+        for url in quiet:
+            results[url] = (get_feed_cache(url) or {}).get('entries', [])[:limit]
+    skipped += quiet
+    pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+    futures = {pool.submit(get_entries, url, limit): url for url in feed_urls if url not in skipped}
+    try:
+        for future in as_completed(futures, timeout=PREFETCH_TIMEOUT):
+            results[futures[future]] = future.result()
+    except FuturesTimeout:
+        late = [url for future, url in futures.items() if not future.done()]
+        logger.warning(f"Не дождались лент за {PREFETCH_TIMEOUT} с: {', '.join(late)}")
+    finally:
+        # Не ждём зависших: их потоки сами упрутся в таймаут requests.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return {url: results.get(url, []) for url in feed_urls}
 
 
 def entry_image(entry):
@@ -37,3 +165,23 @@ def entry_image(entry):
             return link.get('url', '')
 
     return ''
+
+
+def entry_time(entry):
+    """Время публикации записи (unix-время) из published или updated: RSS
+    пишет дату в формате RFC 822, Atom — ISO 8601. None — если даты нет."""
+    for field in ('published', 'updated'):
+        value = entry.get(field)
+        if not value:
+            continue
+        try:
+            moment = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            try:
+                moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            except ValueError:
+                continue
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return moment.timestamp()
+    return None
@@ -0,0 +1,162 @@
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+from loguru import logger
+
+from database import get_state, set_state
+
+# Здоровье лент и автомат-предохранитель (circuit breaker) на каждую, а
+# заодно — когда ленту вообще стоит опрашивать (см. MIN_NEW_PROBABILITY).
+# Мёртвые и медленные ленты (у DeepMind, OpenAI, Nature адреса RSS меняются
+# или отвечают таймаутом) раньше дёргались каждый прогон и каждый раз
+# стоили таймаута. Теперь:
+#   * closed — лента опрашивается как обычно;
+#   * open — после FAILURE_THRESHOLD неудач подряд лента пропускается до
+#     open_until; пауза удваивается с каждым новым срабатыванием (от
+#     BASE_BACKOFF до MAX_BACKOFF);
+#   * half_open — пауза вышла: следующий опрос — пробный. Удался — лента
+#     снова closed, нет — снова open с удвоенной паузой.
+# Записи живут в документе feed_stats (data/feed_stats.json) рядом с
+# итогом последней загрузки: скользящая задержка, неудачи подряд, последний
+# успех, доля «кривых» лент (bozo у feedparser).
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+FAILURE_THRESHOLD = 3
+# Прогоны идут раз в 2 часа — первая пауза пропускает пару прогонов.
+BASE_BACKOFF = 4 * 3600
+MAX_BACKOFF = 7 * 24 * 3600
+# Вес нового замера в скользящих средних.
+EWMA_ALPHA = 0.3
+# Итоги загрузки (см. feeds.get_entries), которые считаются неудачей.
+FAILED_STATUSES = {'error', 'broken'}
+
+# Адаптивный опрос. Ленты пишут с очень разной частотой: Hacker News и
+# Phys.org — много раз в час, DeepMind и OpenAI — несколько раз в месяц.
+# По датам записей из прогона в прогон оценивается интенсивность появления
+# новых записей λ (поток считается пуассоновским), и вероятность, что с
+# последнего опроса появилось хоть что-то, — 1 − exp(−λ·Δt). Ленту, где она
+# ниже MIN_NEW_PROBABILITY, не качаем (см. feeds.prefetch), но не дольше
+# MAX_POLL_INTERVAL: оценка могла устареть.
+MIN_NEW_PROBABILITY = 0.2
+MAX_POLL_INTERVAL = 24 * 3600
+# Оценка λ — отношение экспоненциально забываемых сумм «сколько пришло»
+# и «сколько наблюдали»: за RATE_HALF_LIFE вес старых наблюдений падает вдвое.
+RATE_HALF_LIFE = 7 * 24 * 3600
+
+_lock = threading.Lock()
+
+
+def _ewma(previous, value):
+    return value if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * value
+
+
+def circuit(record, now=None):
+    now = time.time() if now is None else now
+    open_until = record.get('open_until')
+    if open_until is None:
+        return CLOSED
+    return OPEN if now < open_until else HALF_OPEN
+
+
+def allow(feed_url):
+    """Опрашивать ли ленту сейчас: да, кроме разомкнутого предохранителя."""
+    return circuit(get_state(feed_url, default={}, doc='feed_stats')) != OPEN
+
+
+def record(feed_url, status, latency, entries=0, bozo=False):
+    """Учитывает итог загрузки ленты и переключает предохранитель."""
+    now = time.time()
+    with _lock:
+        stats = dict(get_state(feed_url, default={}, doc='feed_stats'))
+        was = circuit(stats, now)
+        stats.update(fetched_at=int(now), status=status, latency=round(latency, 3), entries=entries)
+        stats['latency_ewma'] = round(_ewma(stats.get('latency_ewma'), latency), 3)
+        # bozo имеет смысл только для ленты, которую разбирали.
+        if status in ('ok', 'broken'):
+            stats['bozo_rate'] = round(_ewma(stats.get('bozo_rate'), float(bozo)), 3)
+
+        if status in FAILED_STATUSES:
+            stats['failures'] = stats.get('failures', 0) + 1
+            if was == HALF_OPEN or stats['failures'] >= FAILURE_THRESHOLD:
+                stats['trips'] = stats.get('trips', 0) + 1
+                backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (stats['trips'] - 1))
+                stats['open_until'] = int(now + backoff)
+                logger.warning(f"Лента {feed_url}: {stats['failures']} неудач подряд, пропускаю {backoff / 3600:.0f} ч")
+        else:
+            if was == HALF_OPEN:
+                logger.info(f"Лента {feed_url} снова отвечает")
+            stats.update(failures=0, trips=0, last_success=int(now))
+            stats.pop('open_until', None)
+        set_state(feed_url, stats, doc='feed_stats')
+
+
+def observe(feed_url, published):
+    """Учитывает даты записей ленты (unix-время, None — даты нет) после
+    удачной загрузки и обновляет оценку λ (см. MIN_NEW_PROBABILITY)."""
+    published = [ts for ts in published if ts is not None]
+    if not published:
+        return
+    now = time.time()
+    with _lock:
+        stats = dict(get_state(feed_url, default={}, doc='feed_stats'))
+        newest = stats.get('newest')
+        if newest is None:
+            # Первое наблюдение: записи в ленте — это всё, что пришло с
+            # момента самой старой из них.
+            arrivals, exposure = len(published) - 1, now - min(published)
+        else:
+            elapsed = max(0.0, now - stats['observed_at'])
+            decay = 0.5 ** (elapsed / RATE_HALF_LIFE)
+            arrivals = stats['arrivals'] * decay + sum(ts > newest for ts in published)
+            exposure = stats['exposure'] * decay + elapsed
+        stats.update(
+            arrivals=round(arrivals, 3), exposure=round(exposure),
+            rate=round(arrivals / exposure, 9) if exposure > 0 else None,
+            newest=max(published + ([newest] if newest is not None else [])),
+            observed_at=int(now),
+        )
+        set_state(feed_url, stats, doc='feed_stats')
+
+
+def new_probability(stats, now=None):
+    """Вероятность, что в ленте появилось новое с последнего наблюдения;
+    None — если оценки ещё нет."""
+    if stats.get('rate') is None:
+        return None
+    now = time.time() if now is None else now
+    return 1 - math.exp(-stats['rate'] * max(0.0, now - stats['observed_at']))
+
+
+def worth_polling(feed_url):
+    """Стоит ли качать ленту в этот прогон: скорее всего есть новое, или
+    оценки нет, или лента давно не опрашивалась (MAX_POLL_INTERVAL)."""
+    stats = get_state(feed_url, default={}, doc='feed_stats')
+    probability = new_probability(stats)
+    if probability is None or probability >= MIN_NEW_PROBABILITY:
+        return True
+    return time.time() - stats.get('fetched_at', 0) >= MAX_POLL_INTERVAL
+
+
+def _when(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M') if ts else '—'
+
+
+def print_table(all_sources):
+    """Таблица здоровья лент для `python main.py health`."""
+    now = time.time()
+    print(f"{'источник':<32}{'состояние':<11}{'неудач':>7}{'задержка':>10}{'bozo':>6}{'записей/сут':>12}"
+          f"{'P(новое)':>9}  {'последний успех':<18}{'следующая проба':<18}")
+    for _, source_name, feed_url in all_sources:
+        stats = get_state(feed_url, default={}, doc='feed_stats')
+        state = circuit(stats, now)
+        latency = stats.get('latency_ewma')
+        rate = stats.get('rate')
+        probability = new_probability(stats, now)
+        print(
+            f"{source_name[:31]:<32}{state:<11}{stats.get('failures', 0):>7}"
+            f"{'—' if latency is None else f'{latency:.2f} с':>10}{stats.get('bozo_rate', 0):>6.2f}"
+            f"{'—' if rate is None else f'{rate * 86400:.1f}':>12}"
+            f"{'—' if probability is None else f'{probability:.2f}':>9}  "
+            f"{_when(stats.get('last_success')):<18}{_when(stats.get('open_until')) if state == OPEN else '—':<18}"
+        )
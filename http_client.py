@@ -0,0 +1,171 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import tracing
+from config import HTTP_TIMEOUTS
+
+# Все исходящие запросы бота идут через одну сессию requests: соединения к
+# одному хосту переиспользуются (keep-alive), и пять запросов к
+# api.telegram.org или openrouter.ai за прогон стоят одного TCP+TLS
+# рукопожатия, а не пяти. Заодно здесь единые таймауты по хостам и повторы.
+DEFAULT_TIMEOUT = 30
+# Хостов за прогон ~25 (ленты, страницы статей, картинки) — пул на каждый,
+# соединений на хост — с запасом на параллельные стадии конвейера.
+POOL_HOSTS = 64
+POOL_CONNECTIONS_PER_HOST = 8
+
+MAX_RETRIES = 2
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 20.0
+# Retry-After длиннее этого не ждём внутри прогона — отдаём ответ вызывающему
+# коду как есть, пусть решает сам (дневной лимит OpenRouter, например, ждать
+# бессмысленно).
+MAX_RETRY_AFTER = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_CONNECTIONS_PER_HOST)
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _host(url):
+    return (urlsplit(url).hostname or '').lower()
+
+
+def _timeout_for(host):
+    return HTTP_TIMEOUTS.get(host, DEFAULT_TIMEOUT)
+
+
+def _record(host, latency=None, retry=False, error=False):
+    with _stats_lock:
+        stats = _stats.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0, 'latency_total': 0.0, 'latency_max': 0.0})
+        if retry:
+            stats['retries'] += 1
+            tracing.incr('http.retries')
+        if error:
+            stats['errors'] += 1
+        if latency is not None:
+            stats['requests'] += 1
+            stats['latency_total'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+
+
+def retry_after(response):
+    """Retry-After в секундах (число или HTTP-дата), None — если заголовка нет."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _not_sent(error):
+    """Запрос заведомо не ушёл на сервер: соединение не установилось
+    (отказ, не резолвится хост, таймаут соединения). requests заворачивает
+    причину из urllib3 в MaxRetryError внутри своего ConnectionError."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+def _backoff(attempt):
+    # «Полный джиттер»: равномерно от нуля до экспоненты — параллельные
+    # потоки, упёршиеся в один и тот же 503, не повторяют залпом.
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def request(method, url, timeout=None, retries=MAX_RETRIES, idempotent=True,
+            retry_statuses=RETRY_STATUSES, **kwargs):
+    """Запрос через общую сессию с повторами. Возвращает последний ответ
+    (проверять статус — дело вызывающего кода, как с обычным requests) или
+    бросает исключение последней попытки.
+
+    Повторяются сетевые ошибки и статусы из RETRY_STATUSES, с экспоненциальной
+    паузой со случайным разбросом, а если сервер прислал Retry-After — ровно
+    столько, сколько он просит. idempotent=False (отправка поста) —
+    повторяем только то, что заведомо не дошло: отказ в соединении и 429;
+    таймаут чтения мог случиться уже после публикации. retry_statuses —
+    чтобы не повторять статусы, которые вызывающий код разбирает сам
+    (429 от сервисов с лимитами, см. ratelimit.py)."""
+    host = _host(url)
+    timeout = timeout if timeout is not None else _timeout_for(host)
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        try:
+            response = _session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record(host, error=True)
+            safe = idempotent or _not_sent(e)
+            if attempt >= retries or not safe:
+                raise
+            _record(host, retry=True)
+            delay = _backoff(attempt)
+            logger.debug(f"{method} {host}: {e}, повтор через {delay:.1f} с")
+            time.sleep(delay)
+            continue
+
+        _record(host, latency=time.monotonic() - started)
+        if response.status_code not in retry_statuses or attempt >= retries:
+            return response
+        if not idempotent and response.status_code != 429:
+            return response
+
+        delay = retry_after(response)
+        if delay is None:
+            delay = _backoff(attempt)
+        elif delay > MAX_RETRY_AFTER:
+            return response
+        response.close()
+        _record(host, retry=True)
+        logger.debug(f"{method} {host}: HTTP {response.status_code}, повтор через {delay:.1f} с")
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def stats():
+    """Счётчики по хостам: запросы, повторы, ошибки, задержки и сколько
+    новых соединений открыл пул (меньше запросов — значит, keep-alive
+    сработал)."""
+    with _stats_lock:
+        result = {host: dict(values) for host, values in _stats.items()}
+    for key in list(_adapter.poolmanager.pools.keys()):
+        pool = _adapter.poolmanager.pools.get(key)
+        if pool is not None and key.key_host in result:
+            result[key.key_host]['connections'] = result[key.key_host].get('connections', 0) + pool.num_connections
+    return result
+
+
+def log_stats():
+    for host, values in sorted(stats().items()):
+        average = values['latency_total'] / values['requests'] if values['requests'] else 0
+        logger.info(
+            f"HTTP {host}: запросов {values['requests']}, соединений {values.get('connections', 0)}, "
+            f"повторов {values['retries']}, ошибок {values['errors']}, "
+            f"задержка ср. {average:.2f} с / макс. {values['latency_max']:.2f} с"
+        )
@@ -1,11 +1,13 @@
 from urllib.parse import quote
 
+from config import POLLINATIONS_URL
+
 # Pollinations.ai — бесплатная генерация изображений без ключа и без карты:
 # сама картинка рендерится по требованию, когда Telegram скачивает URL, так
 # что нам не нужно ничего скачивать/загружать самим — просто отдаём ссылку
 # в sendPhoto, как и обычную картинку из RSS. Если сервис недоступен или
 # генерация не удалась — publisher.py уже умеет откатываться на текст без фото.
-BASE_URL = 'https://image.pollinations.ai/prompt/'
+BASE_URL = POLLINATIONS_URL
 
 
 def generate_image_url(image_prompt):
@@ -1,35 +1,221 @@
-import requests
+import io
+import queue
+import threading
+import time
+
 from loguru import logger
+from PIL import Image, ImageOps
+
+import http_client
+import tracing
+
+# Кандидаты картинки идут по приоритету (RSS -> og:image -> Pexels ->
+# Pollinations), но ждать 90 с отказа одного, прежде чем тронуть следующий,
+# слишком дорого. Следующий кандидат стартует, если предыдущий не справился
+# за HEDGE_DELAY секунд (или сразу, если упал). Успех менее приоритетного
+# кандидата ждёт ещё HEDGE_DELAY более приоритетных, а дальше побеждает.
+HEDGE_DELAY = 5
+# Потолок размера картинки: Telegram всё равно не примет фото больше 10 МБ,
+# а читать многомегабайтный PNG целиком, чтобы потом его выбросить, незачем.
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Нормализация перед отправкой (см. normalize): Telegram всё равно ужимает
+# фото до 1280 px по большей стороне, так что мегабайтные PNG с og:image и
+# рендеры Pollinations уходили бы в сеть зря. Бюджет JPEG — с запасом на
+# качество: обычное фото на 1280 px укладывается в него с quality 85.
+MAX_SIDE = 1280
+JPEG_BUDGET = 350 * 1024
+JPEG_QUALITIES = (85, 75, 65, 55)
+# Меньше этого по большей стороне не ужимаем, даже если бюджет не сошёлся.
+MIN_SIDE = 480
+# Заголовок картинки читается до декодирования: «бомбу» на сотни мегапикселей
+# отсекаем, не раскрывая её в память.
+MAX_PIXELS = 40_000_000
+
+# Сигнатуры форматов, которые принимает sendPhoto. content-type врёт
+# (бывает image/jpeg на HTML-заглушке), а первые байты — нет.
+IMAGE_SIGNATURES = (
+    b'\xff\xd8\xff',        # JPEG
+    b'\x89PNG\r\n\x1a\n',   # PNG
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',                  # BMP
+)
 
 
-def download_image(url, timeout=90):
+def _looks_like_image(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    return head.startswith(IMAGE_SIGNATURES)
+
+
+def download_image(url, timeout=None, cancel=None):
     """Скачивает картинку и возвращает (байты, content-type), если URL реально
     отдал изображение. Пустые байты/text not image — ошибка: так мы отсекаем
-    битые ссылки и медленные сервисы раньше, чем их попробует Telegram."""
+    битые ссылки и медленные сервисы раньше, чем их попробует Telegram.
+
+    Тело читается потоком: сигнатура проверяется по первым байтам, размер —
+    по мере чтения, а взведённый cancel прерывает загрузку между кусками."""
     if not url:
         return None
 
     try:
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()
+        with http_client.get(url, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('content-type', '')
+            if not content_type.startswith('image/'):
+                logger.warning(f"URL не отдал картинку {url}: content-type={content_type}")
+                return None
+
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if cancel is not None and cancel.is_set():
+                    return None
+                if not chunks and not _looks_like_image(chunk):
+                    logger.warning(f"URL не отдал картинку {url}: неизвестная сигнатура {chunk[:12]!r}")
+                    return None
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    logger.warning(f"Картинка больше {MAX_IMAGE_BYTES} байт, пропускаю {url}")
+                    return None
+                chunks.append(chunk)
     except Exception as e:
         logger.warning(f"Не удалось скачать картинку {url}: {e}")
         return None
 
-    content_type = response.headers.get('content-type', '')
-    if not content_type.startswith('image/') or not response.content:
-        logger.warning(f"URL не отдал картинку {url}: content-type={content_type}")
+    if not chunks:
+        logger.warning(f"URL отдал пустую картинку {url}")
         return None
 
-    return response.content, content_type
+    tracing.incr('bytes.image', size)
+    return b''.join(chunks), content_type
+
+
+def _rgb(image):
+    # JPEG не умеет прозрачность: прозрачный фон логотипов и PNG-иллюстраций
+    # без подложки становится чёрным.
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def normalize(image_bytes):
+    """Приводит картинку к тому, что Telegram покажет: JPEG не больше
+    MAX_SIDE по большей стороне и не больше JPEG_BUDGET байт. JPEG, который
+    уже укладывается в оба предела, возвращается как есть — без лишнего
+    пережатия. None — если картинку не удалось декодировать: Telegram её
+    тоже не примет, пусть лучше победит следующий кандидат.
+
+    Память ограничена: размер проверяется по заголовку до декодирования,
+    а JPEG декодируется сразу в уменьшенном масштабе (draft)."""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            if source.width * source.height > MAX_PIXELS:
+                logger.warning(f"Картинка {source.width}x{source.height} слишком велика, пропускаю")
+                return None
+            if source.format == 'JPEG' and max(source.size) <= MAX_SIDE and len(image_bytes) <= JPEG_BUDGET:
+                return image_bytes
+            source.draft('RGB', (MAX_SIDE, MAX_SIDE))
+            image = _rgb(ImageOps.exif_transpose(source))
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Не удалось декодировать картинку: {e}")
+        return None
 
+    image.thumbnail((MAX_SIDE, MAX_SIDE), Image.Resampling.LANCZOS)
+    while True:
+        for quality in JPEG_QUALITIES:
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+            if buffer.tell() <= JPEG_BUDGET:
+                break
+        if buffer.tell() <= JPEG_BUDGET or max(image.size) <= MIN_SIDE:
+            break
+        image.thumbnail((max(image.size) * 3 // 4,) * 2, Image.Resampling.LANCZOS)
+    tracing.incr('bytes.image_normalized', buffer.tell())
+    return buffer.getvalue()
+
+
+def _attempt(candidate, timeout, cancel):
+    # Кандидат может быть ленивым — функцией, которая вернёт URL (поиск на
+    # Pexels): тогда запрос к API делается, только если до него дошла очередь.
+    try:
+        url = candidate() if callable(candidate) else candidate
+    except Exception as e:
+        logger.warning(f"Не удалось получить URL кандидата картинки: {e}")
+        return None
+    if not url or cancel.is_set():
+        return None
+    result = download_image(url, timeout=timeout, cancel=cancel)
+    image_bytes = normalize(result[0]) if result else None
+    return (image_bytes, url) if image_bytes else None
+
+
+@tracing.traced('images.fetch_image')
+def fetch_image(candidates, timeout=None):
+    """Перебирает кандидатов по приоритету с хеджированием (см. HEDGE_DELAY),
+    возвращает (байты, выбранный_url) лучшей успешно скачанной картинки,
+    уже нормализованной (см. normalize).
+    None, если ни один кандидат не прошёл — вызывающий код пропустит статью,
+    чтобы в канал не уходили посты без фото. Проигравшие загрузки
+    отменяются, как только победитель известен."""
+    if not candidates:
+        return None
+
+    cancels = [threading.Event() for _ in candidates]
+    finished = queue.Queue()
+    results = {}
+
+    # Потоки-демоны, а не ThreadPoolExecutor: зависшая 90-секундная загрузка
+    # проигравшего кандидата не должна держать выход из процесса.
+    def attempt(i):
+        # Результат кладём в очередь при любом исходе: иначе, когда запущены
+        # все кандидаты, finished.get без таймаута ждал бы упавшего вечно.
+        result = None
+        try:
+            result = _attempt(candidates[i], timeout, cancels[i])
+        except Exception:
+            logger.exception(f"Кандидат картинки {i} упал")
+        finally:
+            finished.put((i, result))
+
+    def start(i):
+        threading.Thread(target=attempt, args=(i,), daemon=True).start()
+
+    start(0)
+    started = 1
+    next_hedge = time.monotonic() + HEDGE_DELAY
+    grace_deadline = None
+    try:
+        while True:
+            winners = [i for i in sorted(results) if results[i]]
+            if winners:
+                best = winners[0]
+                if all(i in results for i in range(best)) or time.monotonic() >= grace_deadline:
+                    return results[best]
+            elif started < len(candidates) and (started == len(results) or time.monotonic() >= next_hedge):
+                start(started)
+                started += 1
+                next_hedge = time.monotonic() + HEDGE_DELAY
+                continue
+            elif started == len(results):
+                return None
 
-def fetch_image(candidates, timeout=90):
-    """Пробует кандидатов по очереди, возвращает (байты, выбранный_url)
-    первой успешно скачанной картинки. None, если ни один кандидат не прошёл —
-    вызывающий код пропустит статью, чтобы в канал не уходили посты без фото."""
-    for url in candidates:
-        result = download_image(url, timeout=timeout)
-        if result:
-            return result[0], url
-    return None
\ No newline at end of file
+            if winners:
+                deadline = grace_deadline
+            else:
+                deadline = next_hedge if started < len(candidates) else None
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                i, result = finished.get(timeout=wait)
+            except queue.Empty:
+                continue
+            results[i] = result
+            if result and grace_deadline is None:
+                grace_deadline = time.monotonic() + HEDGE_DELAY
+    finally:
+        for cancel in cancels:
+            cancel.set()
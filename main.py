@@ -1,109 +1,391 @@
+import argparse
+import signal
 import sys
+import threading
+from datetime import datetime, timezone
+from functools import partial
 
 from loguru import logger
 
-from config import FEEDS, CHANNEL_ID, MAX_ARTICLES_PER_RUN, MAX_ARTICLES_PER_FEED
-from database import init_db, is_known, add_news, get_state, set_state
-from feeds import get_entries, entry_image
+from config import (
+    FEEDS, CHANNELS, MAX_ARTICLES_PER_FEED, PIPELINE_LOOKAHEAD, LLM_BATCH_SIZE, DAEMON_POLL_INTERVAL, BACKLOG_SIZE,
+)
+from database import init_db, add_news, delete_state, flush
+from feeds import prefetch, entry_image
 from extractor import get_article
-from ai import process_article
+from ai import process_batch
 from pexels import search_photo
 from image_gen import generate_image_url
 from images import fetch_image
 from publisher import post_news
+from pipeline import run_pipeline
+import backlog
+import channels
+import dedup
+import health
+import http_client
+import ranking
+import ratelimit
+import tracing
 
 logger.remove()
 logger.add(sys.stderr, format="<green>{time}</green> <level>{level}</level> {message}", colorize=True)
 
 
-def run():
-    init_db()
-    posted = 0
+def _fresh(all_sources, prefetched, targets, queued=()):
+    """Записи всех лент, которых ещё не публиковал хотя бы один канал из
+    targets, берущий их категорию. queued — URL, уже взятые в работу
+    (лежат в бэклоге)."""
+    queued = set(queued)
+    fresh = []
+    for category, source_name, feed_url in all_sources:
+        entries = prefetched[feed_url]
+        logger.info(f"[{category}] {source_name}: {len(entries)} записей")
+        if not any(channels.wants(channel, category) for channel in targets):
+            continue
+        for entry in entries:
+            url = entry.get('link', '')
+            # Тот же url может прийти из двух лент одного прогона — в конвейер
+            # его пускаем один раз, иначе обе копии потратят запрос к ИИ.
+            if not url or url in queued:
+                continue
+            if not channels.pending(url, category, targets):
+                tracing.skip('known')
+                continue
+            queued.add(url)
+            fresh.append({'feed_url': feed_url, 'category': category, 'source_name': source_name,
+                          'entry': entry, 'url': url,
+                          'channels': [c['chat_id'] for c in channels.pending(url, category, targets)]})
+    return fresh
+
+
+def _candidates(ranked, targets):
+    """Кандидаты в конвейер по убыванию балла (см. ranking.rank)."""
+    for item in ranked:
+        # Лимит OpenRouter или всех каналов исчерпан — новых кандидатов не
+        # даём: каждый из них упрётся в тот же лимит, а статьи подождут
+        # следующего прогона непомеченными.
+        if ratelimit.deferred('openrouter') or all(ratelimit.deferred('telegram', c['chat_id']) for c in targets):
+            logger.warning("Лимит OpenRouter или Telegram исчерпан, остальные кандидаты — в следующий прогон")
+            return
+        logger.info(f"Кандидат [{item['category']}] {item['source_name']} (балл {item['score']:.2f}): {item['url']}")
+        yield item
+
+
+def _extract(item):
+    text, og_image = get_article(item['url'])
+    if not text:
+        logger.warning(f"Пропуск (не удалось извлечь текст): {item['url']}")
+        tracing.skip('no_text')
+        return None
 
-    # Плоский список источников вместе с их категорией — обходим его по кругу.
-    # Раньше порядок словаря FEEDS + глобальный лимит означали, что первый
-    # же источник (Habr) съедал всю квоту прогона, а остальные не трогались.
-    all_sources = [
+    # Та же новость из другого источника — до ИИ не пускаем: запрос к
+    # OpenRouter и место в канале она уже получила (или получает сейчас).
+    # Копия нужна, только если историю ещё не видел какой-то из каналов,
+    # куда идёт эта статья, — и только им.
+    title = item['entry'].get('title', '')
+    duplicate_of, carried = dedup.find_duplicate(title, text)
+    if duplicate_of:
+        rest = [] if carried is None else [chat_id for chat_id in item['channels'] if chat_id not in carried]
+        if not rest:
+            logger.info(f"Пропуск (та же история, что {duplicate_of}): {item['url']}")
+            tracing.skip('duplicate')
+            return None
+        item['channels'] = rest
+    dedup.claim(item['url'], title, text)
+
+    item.update(text=text, og_image=og_image)
+    return item
+
+
+def _summarize(items):
+    # Пакетом: все статьи, накопившиеся перед стадией ИИ, уходят одним
+    # запросом к OpenRouter (см. ai.process_batch).
+    results = process_batch([(item['entry'].get('title', ''), item['text']) for item in items])
+    summarized = []
+    for item, (title_ru, summary_ru, image_prompt, tags_ru) in zip(items, results):
+        if not summary_ru:
+            logger.warning(f"Пропуск (ИИ не ответил): {item['url']}")
+            tracing.skip('llm_deferred' if ratelimit.deferred('openrouter') else 'llm_failed')
+            summarized.append(None)
+            continue
+        item.update(title_ru=title_ru, summary_ru=summary_ru, image_prompt=image_prompt, tags_ru=tags_ru)
+        summarized.append(item)
+    return summarized
+
+
+def _find_image(item):
+    # Цепочка источников картинки, от самого достоверного к самому
+    # крайнему: настоящая картинка из RSS -> настоящая картинка со
+    # страницы статьи (og:image) -> релевантное стоковое фото по
+    # теме -> и только если вообще ничего не нашли — рисуем сами.
+    # Скачиваем выбранную картинку сами и отдаём байты в Telegram
+    # (см. publisher.post_news): если дать Telegram ссылку, он сам
+    # полезет по ней и срежет посты на медленных сервисах вроде
+    # Pollinations (генерация занимает минуту).
+    # Кандидаты пробуются с хеджированием (см. images.fetch_image), а поиск
+    # на Pexels ленивый: запрос к API уйдёт, только если до него дойдёт
+    # очередь, а не на каждую статью заранее.
+    candidates = [
+        entry_image(item['entry']),
+        item['og_image'],
+        partial(search_photo, item['image_prompt']),
+        generate_image_url(item['image_prompt']),
+    ]
+    image_bytes, image_url = fetch_image(candidates) or (None, '')
+    if not image_bytes:
+        logger.warning(f"Пропуск (не удалось получить картинку): {item['url']}")
+        tracing.skip('no_image')
+        return None
+    item.update(image_bytes=image_bytes, image_url=image_url)
+    return item
+
+
+def _all_sources():
+    # Плоский список источников вместе с их категорией. Порядок ничего не
+    # решает: записи всех лент ранжируются вместе (ranking.py), а частые
+    # посты одного источника гасит штраф за справедливость.
+    return [
         (category, source_name, feed_url)
         for category, sources in FEEDS.items()
         for source_name, feed_url in sources
     ]
-    n_sources = len(all_sources)
 
-    # Точка входа этого прогона — источник, следующий за последним
-    # использованным (см. set_state в конце). По умолчанию — первый.
-    start_index = get_state('feed_cursor', default=0) % n_sources
 
-    visited = 0
-    idx = start_index
-    while posted < MAX_ARTICLES_PER_RUN and visited < n_sources:
-        category, source_name, feed_url = all_sources[idx]
+def _begin():
+    tracing.reset()
+    # Заново и в демоне: load() заодно выбрасывает истории старше окна.
+    dedup.load()
+    # Курсор round-robin из состояния старых версий — его место заняло
+    # ранжирование.
+    delete_state('feed_cursor')
 
-        entries = get_entries(feed_url, MAX_ARTICLES_PER_FEED)
-        logger.info(f"[{category}] {source_name}: {len(entries)} записей")
 
-        for entry in entries:
-            if posted >= MAX_ARTICLES_PER_RUN:
-                break
+def _finish(posted):
+    """Сохраняет состояние и пишет отчёт. posted — chat_id -> сколько
+    опубликовано в канал."""
+    flush()
 
-            url = entry.get('link', '')
-            if not url or is_known(url):
-                continue
+    http_client.log_stats()
+    counters = tracing.report()['counters']
+    logger.info(f"Кэш ответов ИИ: попаданий {counters.get('llm.cache_hits', 0)}, промахов {counters.get('llm.cache_misses', 0)}")
+    path = tracing.write_report(posted=sum(posted.values()), channels=posted, backlog=len(backlog.items()),
+                                http=http_client.stats())
+    logger.info(f"Прогон завершён, опубликовано новостей: {sum(posted.values())}, "
+                f"в бэклоге: {len(backlog.items())} (отчёт: {path})")
 
-            text, og_image = get_article(url)
-            if not text:
-                logger.warning(f"Пропуск (не удалось извлечь текст): {url}")
-                continue
 
-            title_ru, summary_ru, image_prompt, tags_ru = process_article(entry.get('title', ''), text)
-            if not summary_ru:
-                logger.warning(f"Пропуск (ИИ не ответил): {url}")
-                continue
+def prepare(size=BACKLOG_SIZE):
+    """Готовит посты в бэклог, пока у какого-то канала в нём меньше size
+    постов для него: ленты -> текст -> ИИ -> картинка -> backlog.add. Проход
+    один на все каналы, а кандидаты — только тех категорий, которые берут
+    каналы со свободным местом; запросы к OpenRouter тратятся только под
+    него. Возвращает, сколько постов добавлено."""
+    backlog.expire()
+    ready = backlog.items().values()
+    room = {
+        channel['chat_id']: size - sum(1 for r in ready if channels.pending(r['url'], r['category'], [channel]))
+        for channel in CHANNELS
+    }
+    targets = [channel for channel in CHANNELS if room[channel['chat_id']] > 0]
+    if not targets:
+        return 0
 
-            # Цепочка источников картинки, от самого достоверного к самому
-            # крайнему: настоящая картинка из RSS -> настоящая картинка со
-            # страницы статьи (og:image) -> релевантное стоковое фото по
-            # теме -> и только если вообще ничего не нашли — рисуем сами.
-            # Скачиваем выбранную картинку сами и отдаём байты в Telegram
-            # (см. publisher.post_news): если дать Telegram ссылку, он сам
-            # полезет по ней и срежет посты на медленных сервисах вроде
-            # Pollinations (генерация занимает минуту).
-            candidates = [
-                entry_image(entry),
-                og_image,
-                search_photo(image_prompt),
-                generate_image_url(image_prompt),
-            ]
-            image_bytes, image_url = fetch_image(candidates)
-            if not image_bytes:
-                logger.warning(f"Пропуск (не удалось получить картинку): {url}")
-                continue
-            published_at = entry.get('published', '')
+    all_sources = _all_sources()
 
-            if not add_news(category, title_ru, summary_ru, url, image_url, published_at):
-                # Другой источник в этом же прогоне уже добавил тот же url
-                continue
+    # Все ленты качаем заранее и параллельно: ранжированию нужны свежие
+    # записи всех источников сразу.
+    prefetched = prefetch([feed_url for _, _, feed_url in all_sources], MAX_ARTICLES_PER_FEED)
+    # В конвейер идут лучшие по локальному баллу (см. ranking.py), а не
+    # первые попавшиеся: квота OpenRouter — на лучшие истории.
+    ranked = ranking.rank(all_sources, prefetched, _fresh(all_sources, prefetched, targets, queued=backlog.urls()))
+
+    # Истории из бэклога уже «заняты»: их копии из других лент до ИИ не пускаем.
+    for record in backlog.items().values():
+        dedup.claim(record['url'], record['title'], record['text'])
+
+    # Стадии идут конвейером (см. pipeline.py): пока картинка одной статьи
+    # качается, следующая уже извлекается и уходит в ИИ.
+    return run_pipeline(
+        _candidates(ranked, targets),
+        [('extract', _extract), ('summarize', _summarize, LLM_BATCH_SIZE), ('image', _find_image)],
+        backlog.add,
+        limit=max(room[channel['chat_id']] for channel in targets),
+        lookahead=PIPELINE_LOOKAHEAD,
+        gate_stage=1,
+    )
+
+
+def publish(channel, limit):
+    """Публикует в канал до limit лучших готовых постов его категорий из
+    бэклога — по одному вызову Telegram на пост. Пост уходит из бэклога,
+    когда его опубликовали все каналы, которые его берут. Возвращает,
+    сколько опубликовано."""
+    chat_id = channel['chat_id']
+    ready = backlog.items()
+    posted = 0
+    for key in backlog.ordered():
+        if posted >= limit:
+            break
+        record = ready[key]
+        url, category, title_ru = record['url'], record['category'], record['title_ru']
+        if not channels.pending(url, category, [channel]):
+            continue
+        # Копия истории, которая в этом канале уже вышла под другим URL
+        # (пост попал в бэклог ради других каналов), — помечаем её в канале
+        # опубликованной, чтобы не ждала его до конца BACKLOG_TTL.
+        if chat_id in dedup.posted_in(url, record['title'], record['text']):
+            logger.info(f"Пропуск в {chat_id} (та же история там уже вышла): {url}")
+            tracing.skip('duplicate')
+            add_news(category, title_ru, record['summary_ru'], url, record['image_url'], record['published'],
+                     seen=channel['seen'])
+            if not channels.pending(url, category):
+                backlog.discard(key)
+            continue
+        # Лимит, о котором уже известно, — не тратим время на картинку.
+        if ratelimit.deferred('telegram', chat_id):
+            tracing.skip('post_deferred')
+            break
+        image_bytes = backlog.image(key)
+        if not image_bytes:
+            logger.warning(f"Пропуск (картинка поста из бэклога недоступна): {url}")
+            tracing.skip('no_image')
+            backlog.discard(key)
+            continue
+        ok = post_news(chat_id, title_ru, record['summary_ru'], url, image_bytes,
+                       category=category, tags=record['tags_ru'])
+        if ok is None:
+            # Лимит чата: пост остаётся в бэклоге неопубликованным и уйдёт в
+            # следующий прогон.
+            tracing.skip('post_deferred')
+            break
+        # Опубликованная статья (и та, что Telegram не принял, — второй
+        # попытки у неё не будет) помечается в канале; остальным каналам
+        # пост ещё нужен.
+        add_news(category, title_ru, record['summary_ru'], url, record['image_url'], record['published'],
+                 seen=channel['seen'])
+        dedup.remember(url, record['title'], record['text'], chat_id)
+        if not channels.pending(url, category):
+            backlog.discard(key)
+        if not ok:
+            logger.error(f"Не удалось отправить в канал {chat_id}: {url}")
+            tracing.skip('post_failed')
+            continue
+        posted += 1
+        logger.info(f"Опубликовано в {chat_id} [{category}] {title_ru}")
+        # Недавно публиковавшийся источник ранжирование штрафует — так
+        # каждый слот достаётся новому месту, а не вечно одной бойкой ленте.
+        ranking.note_posted(record['feed_url'])
+    return posted
 
-            if post_news(CHANNEL_ID, title_ru, summary_ru, url, image_bytes,
-                     category=category, tags=tags_ru):
-                posted += 1
-                logger.info(f"Опубликовано [{category}] {title_ru}")
-            else:
-                logger.error(f"Не удалось отправить в канал: {url}")
 
-        idx = (idx + 1) % n_sources
-        visited += 1
+def publish_slot(force=False):
+    """Слот публикации для каналов, чей слот наступил (см. channels.due), а
+    с force — для всех каналов: сначала готовое из бэклога, потом пополнение
+    бэклога, и если квоты слота не хватило (бэклог был пуст) — ещё раз
+    публикация. Состояние (init_db) уже поднято."""
+    _begin()
+    now = datetime.now(timezone.utc)
+    due = list(CHANNELS) if force else channels.due(now)
+    if not due:
+        logger.info("Ни у одного канала слот не наступил — только пополняю бэклог")
+    posted = {channel['chat_id']: publish(channel, channel['per_run']) for channel in due}
+    # Бэклог был пуст или мельче квоты слота — готовим хотя бы под неё.
+    prepare(max([BACKLOG_SIZE] + [channel['per_run'] - posted[channel['chat_id']] for channel in due]))
+    for channel in due:
+        if posted[channel['chat_id']] < channel['per_run']:
+            posted[channel['chat_id']] += publish(channel, channel['per_run'] - posted[channel['chat_id']])
+    # Отработанным слот считается, только если квота выбрана: канал, которому
+    # не хватило постов (пустой бэклог, лимит Telegram), доберёт их при
+    # следующем запуске в том же слоте.
+    channels.mark_served([channel for channel in due if posted[channel['chat_id']] >= channel['per_run']], now)
+    _finish(posted)
+
+
+def run(command='run', force=False):
+    """Разовый прогон (cron в GitHub Actions) и выход: 'run' — слот целиком
+    (с force — для всех каналов, не глядя на слоты), 'prepare' — только
+    пополнить бэклог, 'publish' — только опубликовать готовое во все каналы,
+    не глядя на слоты, 'health' — показать таблицу здоровья лент."""
+    init_db()
+    if command == 'health':
+        health.print_table(_all_sources())
+    elif command == 'prepare':
+        _begin()
+        prepare()
+        _finish({})
+    elif command == 'publish':
+        _begin()
+        _finish({channel['chat_id']: publish(channel, channel['per_run']) for channel in CHANNELS})
+    else:
+        publish_slot(force)
+
+
+def _poll_feeds():
+    # Между слотами пополняем бэклог (см. prepare): к слоту готовый пост
+    # уже лежит, и слот — это один вызов Telegram. Если места нет — только
+    # прогреваем кэш лент (условный GET, см. feeds.get_entries).
+    _begin()
+    if not prepare():
+        prefetch([feed_url for _, _, feed_url in _all_sources()], MAX_ARTICLES_PER_FEED)
+    flush()
+
+
+def daemon():
+    """Постоянный процесс вместо cron: публикует по слотам каналов
+    (config.CHANNELS), между ними опрашивает ленты. Пул соединений, кэши и импортированные
+    библиотеки живут весь процесс, состояние сохраняется после каждого
+    слота и опроса. SIGTERM/SIGINT дают доделать текущий слот или опрос и
+    выйти, сохранив состояние."""
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    init_db()
+    for channel in CHANNELS:
+        logger.info(f"Демон запущен, слоты {channel['chat_id']} (UTC): "
+                    f"{', '.join(f'{h:02d}:00' for h in sorted(channel['slots']))}")
+    while not stop.is_set():
+        now = datetime.now(timezone.utc)
+        slot = min(channels.next_slot(channel, now) for channel in CHANNELS)
+        logger.info(f"Следующий слот публикации: {slot:%Y-%m-%d %H:%M} UTC")
+        while not stop.is_set():
+            left = (slot - datetime.now(timezone.utc)).total_seconds()
+            if left <= 0 or stop.wait(min(left, DAEMON_POLL_INTERVAL)):
+                break
+            if slot > datetime.now(timezone.utc):
+                try:
+                    _poll_feeds()
+                except Exception:
+                    logger.exception("Опрос лент упал, продолжаю до слота")
+        if stop.is_set():
+            break
+        # Один неудачный слот не должен ронять демон — следующий попробует снова.
+        try:
+            publish_slot()
+        except Exception:
+            logger.exception("Слот публикации упал")
+    flush()
+    logger.info("Демон остановлен")
 
-    # Следующий прогон начнёт с источника, идущего за последним просмотренным:
-    # так каждый прогон стартует с нового места, а не вечно с Habr.
-    # Если же прогон обошёл весь круг, а не остановился по лимиту (idx снова
-    # равен start_index, курсор «запарковался» бы) — всё равно сдвигаемся на
-    # один вперёд, чтобы проголодавшийся источник не получал все прогоны.
-    cursor = idx if visited < n_sources else (start_index + 1) % n_sources
-    set_state('feed_cursor', cursor)
 
-    logger.info(f"Прогон завершён, опубликовано новостей: {posted}")
+def main():
+    parser = argparse.ArgumentParser(description='Новостной бот для Telegram-канала')
+    parser.add_argument('command', nargs='?', default='run', choices=('run', 'prepare', 'publish', 'health'),
+                        help='run — слот целиком (по умолчанию), prepare — только пополнить бэклог '
+                             'готовых постов, publish — только опубликовать готовое, '
+                             'health — таблица здоровья лент')
+    parser.add_argument('--force', action='store_true',
+                        help='run: публиковать во все каналы, даже если их слот уже отработан')
+    parser.add_argument('--daemon', action='store_true',
+                        help='работать постоянно и публиковать по слотам каналов вместо разового прогона')
+    args = parser.parse_args()
+    with tracing.profiled():
+        if args.daemon:
+            daemon()
+        else:
+            run(args.command, args.force)
 
 
 if __name__ == '__main__':
-    run()
+    main()
@@ -1,28 +1,117 @@
-import requests
+import threading
+import time
+
 from loguru import logger
 
-from config import PEXELS_API_KEY
+import http_client
+import tracing
+from config import PEXELS_API_KEY, PEXELS_API_URL
+from database import get_state, set_state, get_document, evict
+from dedup import STOPWORDS, WORD_RE
+
+API_URL = PEXELS_API_URL
+
+# Кэш поиска: раньше каждая статья спрашивала per_page=1 и выбрасывала
+# ответ, а похожие описания картинок («robot arm in factory», «factory robot
+# arm») снова шли в API и получали то же первое фото — оно и повторялось в
+# канале. Теперь на нормализованный запрос (множество стемов, см. _terms)
+# берётся страница из PER_PAGE фото, она лежит в документе 'pexels_cache'
+# (data/pexels_cache.json), а каждый вызов выдаёт следующее фото, которое
+# недавно не выдавалось.
+PER_PAGE = 15
+PEXELS_CACHE_TTL = 7 * 24 * 3600
+PEXELS_CACHE_MAX_ENTRIES = 200
+# Запрос, совпадающий с закэшированным по Жаккару стемов не меньше этого,
+# берёт его страницу без похода в API.
+QUERY_SIMILARITY = 0.6
+# Выданное фото столько не выдаётся снова (пока в странице есть другие).
+PHOTO_REUSE_WINDOW = 30 * 24 * 3600
+# Стемминг обрезкой, короче, чем в dedup.py: описания картинок — несколько
+# слов, и «robot»/«robotic», «factory»/«factories» должны совпасть.
+QUERY_STEM_LENGTH = 5
+
+# Фото ищут параллельные потоки стадии картинок — выбор и отметка «выдано»
+# должны идти парой.
+_lock = threading.Lock()
+
+
+def _terms(query):
+    return {
+        word.removesuffix('s')[:QUERY_STEM_LENGTH] for word in WORD_RE.findall(query.lower())
+        if len(word) > 2 and word not in STOPWORDS
+    }
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
 
-API_URL = 'https://api.pexels.com/v1/search'
+def _lookup(terms, now):
+    """Ключ закэшированного запроса, ближайшего к terms, или None."""
+    best, best_similarity = None, QUERY_SIMILARITY
+    for key, entry in get_document('pexels_cache').items():
+        if now - entry['ts'] >= PEXELS_CACHE_TTL:
+            continue
+        similarity = _jaccard(terms, set(entry['terms']))
+        if similarity >= best_similarity:
+            best, best_similarity = key, similarity
+    return best
+
+
+def _store(key, terms, photos, now):
+    set_state(key, {'terms': sorted(terms), 'photos': photos, 'ts': int(now), 'used_at': int(now)},
+              doc='pexels_cache')
+    # Просроченные — вон, а сверх лимита вытесняем давно не нужные.
+    evict('pexels_cache', PEXELS_CACHE_TTL, PEXELS_CACHE_MAX_ENTRIES, lru_field='used_at')
+
+
+def _fetch(query):
+    headers = {'Authorization': PEXELS_API_KEY}
+    params = {'query': query, 'per_page': PER_PAGE, 'orientation': 'landscape'}
+    response = http_client.get(API_URL, headers=headers, params=params)
+    response.raise_for_status()
+    return [photo['src']['large'] for photo in response.json().get('photos', [])]
+
+
+def _pick(key, now):
+    """Следующее фото страницы, которое давно не выдавалось (а если выданы
+    все — то, что выдавалось раньше всех), и отметка о выдаче."""
+    entry = get_state(key, default=None, doc='pexels_cache')
+    if not entry['photos']:
+        return ''
+    used = {url: ts for url, ts in get_state('pexels_used', default={}).items() if now - ts < PHOTO_REUSE_WINDOW}
+    photo = min(entry['photos'], key=lambda url: used.get(url, 0))
+    used[photo] = int(now)
+    set_state('pexels_used', used)
+    set_state(key, {**entry, 'used_at': int(now)}, doc='pexels_cache')
+    return photo
 
 
 def search_photo(query):
-    """Ищет одно стоковое фото по ключевым словам. Пустая строка, если
-    ничего не нашли или запрос не удался — вызывающий код просто идёт
-    дальше по цепочке источников картинки."""
-    if not query:
+    """Ищет стоковое фото по ключевым словам — из кэша страниц, если похожий
+    запрос уже был, иначе одним запросом к API. Пустая строка, если ничего
+    не нашли или запрос не удался — вызывающий код просто идёт дальше по
+    цепочке источников картинки."""
+    terms = _terms(query or '')
+    if not terms:
         return ''
 
-    headers = {'Authorization': PEXELS_API_KEY}
-    params = {'query': query, 'per_page': 1, 'orientation': 'landscape'}
+    now = time.time()
+    with _lock:
+        key = _lookup(terms, now)
+        if key is not None:
+            tracing.incr('pexels.cache_hits')
+            return _pick(key, now)
+    tracing.incr('pexels.cache_misses')
 
     try:
-        response = requests.get(API_URL, headers=headers, params=params, timeout=20)
-        response.raise_for_status()
-        photos = response.json().get('photos', [])
-        if not photos:
-            return ''
-        return photos[0]['src']['large']
+        photos = _fetch(query)
     except Exception as e:
         logger.error(f"Ошибка запроса к Pexels: {e}")
         return ''
+    # Пустой ответ тоже кэшируем: тот же бесполезный запрос не стоит
+    # повторять всю неделю.
+    key = ' '.join(sorted(terms))
+    with _lock:
+        _store(key, terms, photos, now)
+        return _pick(key, now)
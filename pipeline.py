@@ -0,0 +1,169 @@
+import queue
+import threading
+import time
+
+from loguru import logger
+
+# Конвейер обработки статей: каждая стадия (извлечение текста, ИИ, картинка)
+# работает в своём потоке, между стадиями — очереди на один элемент. Пока
+# одна статья ждёт минуту рендера Pollinations, следующая уже извлекается и
+# суммаризуется. Очереди маленькие намеренно: всё, что обработано сверх
+# квоты прогона, — потраченные впустую запросы к внешним сервисам.
+QUEUE_SIZE = 1
+# Как часто заблокированные потоки проверяют флаг остановки.
+POLL_INTERVAL = 0.2
+# Сколько ждём, пока стадии доделают текущий элемент после остановки, —
+# дальше потоки-демоны просто бросаем: их работа уже не нужна.
+DRAIN_TIMEOUT = 30
+# Сколько пакетная стадия ждёт, пока в пакет наберутся ещё элементы: первый
+# элемент не должен простаивать дольше, чем извлекается следующая статья.
+BATCH_WAIT = 3
+
+_END = object()
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def _acquire(semaphore, stop):
+    while not stop.is_set():
+        if semaphore.acquire(timeout=POLL_INTERVAL):
+            return True
+    return False
+
+
+def run_pipeline(source, stages, sink, limit, lookahead=0, gate_stage=0):
+    """Прогоняет элементы source через stages и отдаёт результат в sink,
+    пока sink не примет limit элементов (или не кончатся кандидаты).
+
+    stages — список пар (имя, функция): функция получает элемент и
+    возвращает его же (дополненным) или None, если элемент надо отбросить.
+    Пакетная стадия задаётся тройкой (имя, функция, размер_пакета): функция
+    получает список до размер_пакета элементов и возвращает список той же
+    длины (с None на месте отброшенных).
+    sink вызывается в текущем потоке, по порядку, и возвращает True, если
+    элемент засчитан в limit (например, пост реально ушёл в канал).
+
+    lookahead ограничивает спекуляцию: начиная со стадии gate_stage в работе
+    одновременно не больше (оставшийся limit + lookahead) элементов. Это то,
+    что держит в узде дорогие стадии (квота OpenRouter): следующая статья
+    пойдёт в ИИ, только когда одна из текущих отброшена. Возвращает число
+    принятых sink элементов."""
+    stop = threading.Event()
+    gate = threading.Semaphore(limit + lookahead)
+    accepted = 0
+    # Перед пакетной стадией очередь длиннее — иначе пакету неоткуда набраться.
+    queues = [queue.Queue(maxsize=QUEUE_SIZE) for _ in range(len(stages) + 1)]
+    for i, stage in enumerate(stages):
+        if len(stage) > 2:
+            queues[i] = queue.Queue(maxsize=max(QUEUE_SIZE, stage[2]))
+
+    def feed():
+        try:
+            for item in source:
+                if not _put(queues[0], item, stop):
+                    return
+        except Exception:
+            logger.exception("Ошибка источника кандидатов конвейера")
+        _put(queues[0], _END, stop)
+
+    def collect(inbox, batch_size, gated):
+        # Первый элемент ждём сколько угодно, остальные — не дольше
+        # BATCH_WAIT и только пока гейт пускает: пакет не должен раздувать
+        # спекуляцию сверх lookahead.
+        batch, finished = [], False
+        deadline = time.monotonic() + BATCH_WAIT
+        while len(batch) < batch_size:
+            if batch and gated and not gate.acquire(blocking=False):
+                break
+            if not batch:
+                item = _get(inbox, stop)
+                if item is not _END and gated and not _acquire(gate, stop):
+                    return batch, True
+            else:
+                try:
+                    item = inbox.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    if gated:
+                        gate.release()
+                    break
+            if item is _END:
+                if batch and gated:
+                    gate.release()
+                finished = True
+                break
+            batch.append(item)
+        return batch, finished
+
+    def work(index, name, func, batch_size=None):
+        inbox, outbox = queues[index], queues[index + 1]
+        gated = index == gate_stage
+        while True:
+            if batch_size:
+                batch, finished = collect(inbox, batch_size, gated)
+            else:
+                item = _get(inbox, stop)
+                finished = item is _END
+                batch = [] if finished else [item]
+                if batch and gated and not _acquire(gate, stop):
+                    return
+
+            if batch:
+                try:
+                    results = func(batch) if batch_size else [func(batch[0])]
+                except Exception:
+                    logger.exception(f"Ошибка на стадии {name}")
+                    results = [None] * len(batch)
+                for result in results:
+                    if result is None:
+                        if index >= gate_stage:
+                            gate.release()
+                    elif not _put(outbox, result, stop):
+                        return
+
+            if finished:
+                _put(outbox, _END, stop)
+                return
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads += [
+        threading.Thread(target=work, args=(i, *stage), daemon=True, name=f'stage-{stage[0]}')
+        for i, stage in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while accepted < limit:
+            item = _get(queues[-1], stop)
+            if item is _END:
+                break
+            # Принятый элемент занимает своё место в гейте навсегда — так
+            # спекуляция сжимается вместе с остатком квоты.
+            if sink(item):
+                accepted += 1
+            else:
+                gate.release()
+    finally:
+        stop.set()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for thread in threads:
+            thread.join(timeout=max(0, deadline - time.monotonic()))
+
+    return accepted
@@ -1,12 +1,26 @@
+import hashlib
 import html
 import re
+import time
 
-import requests
 from loguru import logger
 
-from config import BOT_TOKEN
+import http_client
+import ratelimit
+import tracing
 
-API_URL = f'https://api.telegram.org/bot{BOT_TOKEN}'
+from config import BOT_TOKEN, TELEGRAM_API_URL
+from database import get_state, set_state, delete_state, evict
+
+API_URL = f'{TELEGRAM_API_URL}/bot{BOT_TOKEN}'
+# Сколько раз повторять отправку после 429 с паузой из retry_after.
+RATE_LIMIT_RETRIES = 2
+# Однажды загруженное фото Telegram хранит у себя и отдаёт его file_id —
+# повторная отправка той же картинки (то же стоковое фото с Pexels) по
+# file_id не гонит байты заново. Соответствие «хеш картинки -> file_id»
+# живёт в документе 'tg_files' (data/tg_files.json); сверх лимита
+# вытесняются давно не использованные.
+FILE_IDS_MAX_ENTRIES = 500
 
 
 def _normalize_tags(category, tags, max_tags=3):
@@ -60,23 +74,83 @@ def _build_caption(title, summary, url, tags, max_length):
     return prefix + html.escape(summary) + suffix
 
 
+def _send(chat_id, method, data, files=None):
+    """Вызов Bot API с учётом лимита чата: ждёт свободный слот и на 429
+    повторяет после retry_after, который назвал Telegram. None — если
+    отправить в этом прогоне нельзя (ждать дольше ratelimit.MAX_WAIT)."""
+    for _ in range(RATE_LIMIT_RETRIES + 1):
+        if not ratelimit.acquire('telegram', key=chat_id):
+            return None
+        response = http_client.post(
+            f'{API_URL}/{method}', data=data, files=files,
+            idempotent=False, retry_statuses=ratelimit.RETRY_STATUSES,
+        )
+        if response.status_code != 429:
+            return response
+        ratelimit.throttled('telegram', response, key=chat_id)
+    return None
+
+
+def _photo_key(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()[:32]
+
+
+def _remember_file_id(key, response):
+    try:
+        file_id = response.json()['result']['photo'][-1]['file_id']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return
+    set_state(key, {'file_id': file_id, 'ts': int(time.time())}, doc='tg_files')
+    evict('tg_files', None, FILE_IDS_MAX_ENTRIES)
+
+
+def _send_photo(chat_id, data, image_bytes, image_content_type):
+    """sendPhoto: по file_id, если эту картинку уже загружали, иначе —
+    загрузкой байтов (и запоминаем выданный file_id)."""
+    key = _photo_key(image_bytes)
+    known = get_state(key, default=None, doc='tg_files')
+    if known:
+        response = _send(chat_id, 'sendPhoto', data={**data, 'photo': known['file_id']})
+        if response is None:
+            return None
+        if response.ok:
+            tracing.incr('bytes.upload_saved', len(image_bytes))
+            set_state(key, {**known, 'ts': int(time.time())}, doc='tg_files')
+            return response
+        # file_id мог стать недействительным — забываем и загружаем заново.
+        logger.warning(f"Telegram не принял file_id ({response.status_code}), загружаю фото заново")
+        delete_state(key, doc='tg_files')
+    response = _send(chat_id, 'sendPhoto', data=data,
+                     files={'photo': ('news.jpg', image_bytes, image_content_type)})
+    if response is not None and response.ok:
+        tracing.incr('bytes.upload', len(image_bytes))
+        _remember_file_id(key, response)
+    return response
+
+
+@tracing.traced('publisher.post_news')
 def post_news(chat_id, title, summary, url, image_bytes, category='',
               tags='', image_content_type='image/jpeg'):
     """Публикует новость в канал. Картинка отправляется байтами (multipart),
     а не ссылкой — Telegram принимает файл напрямую и не зависит от того,
-    доступен ли внешний хост в момент публикации. Если Telegram не смог
+    доступен ли внешний хост в момент публикации; уже загруженная раньше —
+    по file_id (см. _send_photo). Если Telegram не смог
     обработать фото — отправляем тот же текст без фото, чтобы не терять
-    новость полностью."""
+    новость полностью. 429 — не «не смог обработать фото»: тогда ждём,
+    сколько просит Telegram, а не шлём текстом (его тоже притормозят).
+    True — опубликовано, False — не удалось, None — лимит чата, публикация
+    отложена до следующего прогона."""
     hashtags = _normalize_tags(category, tags)
     if image_bytes:
         caption = _build_caption(title, summary, url, hashtags, max_length=1024)
         try:
-            response = requests.post(
-                f'{API_URL}/sendPhoto',
-                data={'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'},
-                files={'photo': ('news.jpg', image_bytes, image_content_type)},
-                timeout=30,
+            response = _send_photo(
+                chat_id, {'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'},
+                image_bytes, image_content_type,
             )
+            if response is None:
+                logger.error("Telegram: лимит чата, публикация отложена")
+                return None
             response.raise_for_status()
             return True
         except Exception as e:
@@ -84,11 +158,10 @@ def post_news(chat_id, title, summary, url, image_bytes, category='',
 
     text = _build_caption(title, summary, url, hashtags, max_length=4096)
     try:
-        response = requests.post(
-            f'{API_URL}/sendMessage',
-            data={'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'},
-            timeout=30,
-        )
+        response = _send(chat_id, 'sendMessage', data={'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'})
+        if response is None:
+            logger.error("Telegram: лимит чата, публикация отложена")
+            return None
         response.raise_for_status()
         return True
     except Exception as e:
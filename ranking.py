@@ -0,0 +1,146 @@
+import math
+import re
+import time
+from collections import Counter, defaultdict
+
+from config import SOURCE_WEIGHTS
+from database import get_state, set_state
+from dedup import STOPWORDS, STEM_LENGTH, WORD_RE
+from feeds import entry_time
+
+# Локальное ранжирование свежих записей всех лент до того, как на них
+# потратится запрос к ИИ. Раньше в работу шла первая непросмотренная запись
+# того источника, на который попал курсор round-robin, а квота OpenRouter
+# доставалась тому, что случайно оказалось первым. Теперь каждая запись
+# получает балл по одним только заголовку и анонсу из RSS:
+#   * релевантность категории — косинус TF-IDF записи к «профилю» своей
+#     категории (центроиду всех записей её лент в этом прогоне): посты не по
+#     теме канала из общих лент (Dev.to, TechCrunch) опускаются вниз;
+#   * свежесть — экспоненциальный спад по времени публикации;
+#   * «тренд» — сколько других источников пишут о том же прямо сейчас;
+#   * вес источника (SOURCE_WEIGHTS в config.py).
+# Вместо курсора — штраф за справедливость: источник, недавно давший пост,
+# и источник, у которого в этот прогон уже взяли статью, опускаются.
+RELEVANCE_WEIGHT = 1.0
+RECENCY_WEIGHT = 1.0
+TRENDING_WEIGHT = 0.7
+# Запись такого возраста получает половину балла свежести.
+RECENCY_HALF_LIFE = 12 * 3600
+# Без даты публикации — как запись этого возраста.
+UNKNOWN_AGE = 24 * 3600
+# Косинус TF-IDF, с которого записи двух лент считаются одной историей.
+TREND_SIMILARITY = 0.35
+# Столько других источников с той же историей — уже полный балл тренда.
+TREND_SATURATION = 2
+# Штраф источнику, давшему последний пост; спадает вдвое за FAIRNESS_HALF_LIFE.
+FAIRNESS_PENALTY = 0.6
+FAIRNESS_HALF_LIFE = 12 * 3600
+# Штраф каждой следующей статье того же источника в одном прогоне.
+SAME_SOURCE_PENALTY = 0.4
+# Сколько лучших записей отдавать в конвейер (извлечение и ИИ).
+TOP_K = 12
+
+TAG_RE = re.compile(r'<[^>]+>')
+
+
+def _terms(text):
+    return Counter(
+        word[:STEM_LENGTH] for word in WORD_RE.findall(TAG_RE.sub(' ', text).lower())
+        if len(word) > 2 and word not in STOPWORDS and not word.isdigit()
+    )
+
+
+def _vectors(documents):
+    """TF-IDF векторы (словари термин -> вес), нормированные по длине."""
+    df = Counter(term for terms in documents for term in terms)
+    n = len(documents)
+    vectors = []
+    for terms in documents:
+        vector = {term: (1 + math.log(count)) * math.log((1 + n) / (1 + df[term])) for term, count in terms.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        vectors.append({term: w / norm for term, w in vector.items()})
+    return vectors
+
+
+def _cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(w * b.get(term, 0.0) for term, w in a.items())
+
+
+def _centroid(vectors):
+    total = defaultdict(float)
+    for vector in vectors:
+        for term, w in vector.items():
+            total[term] += w
+    norm = math.sqrt(sum(w * w for w in total.values())) or 1.0
+    return {term: w / norm for term, w in total.items()}
+
+
+def _age(entry, now):
+    published = entry_time(entry)
+    return UNKNOWN_AGE if published is None else max(0.0, now - published)
+
+
+def source_penalty(feed_url, now=None):
+    """Штраф за справедливость: тем больше, чем недавнее источник давал пост."""
+    posted_at = get_state('source_posted', default={}).get(feed_url)
+    if posted_at is None:
+        return 0.0
+    now = time.time() if now is None else now
+    return FAIRNESS_PENALTY * 0.5 ** (max(0.0, now - posted_at) / FAIRNESS_HALF_LIFE)
+
+
+def note_posted(feed_url):
+    posted = dict(get_state('source_posted', default={}))
+    posted[feed_url] = int(time.time())
+    set_state('source_posted', posted)
+
+
+def rank(all_sources, prefetched, fresh, top_k=TOP_K):
+    """Ранжирует свежие записи. all_sources — [(категория, имя, url ленты)],
+    prefetched — url ленты -> все записи (корпус для IDF и профилей
+    категорий), fresh — кандидаты-словари с ключами category, source_name,
+    feed_url, entry. Возвращает до top_k кандидатов по убыванию балла,
+    с итоговым баллом в ключе 'score' и баллом без штрафов за
+    справедливость в 'merit'."""
+    corpus = [
+        (category, source_name, feed_url, entry)
+        for category, source_name, feed_url in all_sources
+        for entry in prefetched.get(feed_url, [])
+    ]
+    if not fresh or not corpus:
+        return []
+    vectors = _vectors([_terms(f"{entry.get('title', '')} {entry.get('summary', '')}") for *_, entry in corpus])
+    by_link = {entry.get('link'): vector for (*_, entry), vector in zip(corpus, vectors)}
+    profiles = {}
+    for category in {category for category, *_ in corpus}:
+        profiles[category] = _centroid([v for (c, *_), v in zip(corpus, vectors) if c == category])
+
+    now = time.time()
+    scored = []
+    for candidate in fresh:
+        entry = candidate['entry']
+        vector = by_link.get(entry.get('link'), {})
+        relevance = _cosine(vector, profiles.get(candidate['category'], {}))
+        recency = 0.5 ** (_age(entry, now) / RECENCY_HALF_LIFE)
+        echoes = {
+            source_name for (_, source_name, feed_url, _), other in zip(corpus, vectors)
+            if feed_url != candidate['feed_url'] and _cosine(vector, other) >= TREND_SIMILARITY
+        }
+        trending = min(1.0, len(echoes) / TREND_SATURATION)
+        merit = (RELEVANCE_WEIGHT * relevance + RECENCY_WEIGHT * recency + TRENDING_WEIGHT * trending) \
+            * SOURCE_WEIGHTS.get(candidate['source_name'], 1.0)
+        scored.append((merit - source_penalty(candidate['feed_url'], now), {**candidate, 'merit': round(merit, 4)}))
+
+    # Жадный выбор: каждая взятая статья источника штрафует следующие его
+    # статьи — одна бойкая лента не забирает весь top-k.
+    taken = Counter()
+    result = []
+    while scored and len(result) < top_k:
+        best = max(range(len(scored)), key=lambda i: scored[i][0] - SAME_SOURCE_PENALTY * taken[scored[i][1]['feed_url']])
+        score, candidate = scored.pop(best)
+        score -= SAME_SOURCE_PENALTY * taken[candidate['feed_url']]
+        taken[candidate['feed_url']] += 1
+        result.append({**candidate, 'score': round(score, 4)})
+    return result
@@ -0,0 +1,160 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from loguru import logger
+
+import http_client
+from config import RATE_LIMITS
+from database import get_state, set_state
+
+# Планировщик вызовов к сервисам с лимитами (OpenRouter, Telegram): до
+# запроса решает, можно ли идти сейчас, стоит подождать или вызов надо
+# отложить до следующего прогона. Раньше 429 от OpenRouter считался обычной
+# ошибкой — статья пропускалась, а следующая тут же упиралась в тот же 429;
+# прогон жёг запросы, про которые уже было известно, что их отклонят.
+#
+# На каждый сервис (для Telegram — на каждый чат) — ведро токенов на
+# минутный лимит, счётчик суточной квоты со сбросом в полночь UTC (так
+# считает OpenRouter) и «заблокировано до» из retry_after последнего 429.
+# Всё это живёт в документе 'ratelimit' (data/ratelimit.json), так что
+# следующий прогон знает, что квота на сегодня кончилась, не спрашивая
+# сервер.
+NOW, WAIT, DEFER = 'now', 'wait', 'defer'
+# Дольше этого внутри прогона не ждём — откладываем до следующего.
+MAX_WAIT = 60
+# Если 429 пришёл без retry_after — столько считаем сервис занятым.
+DEFAULT_BLOCK = 60
+# 429 этих сервисов разбирает планировщик, а не повторы http_client:
+# вслепую повторять запрос, на который сервер сказал «не раньше чем через
+# N секунд», — значит потратить ещё одну попытку впустую.
+RETRY_STATUSES = http_client.RETRY_STATUSES - {429}
+
+_lock = threading.Lock()
+
+
+def _utc_day(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).date().isoformat()
+
+
+def _until_midnight(ts):
+    now = datetime.fromtimestamp(ts, timezone.utc)
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), timezone.utc)
+    return (midnight - now).total_seconds()
+
+
+def _name(service, key):
+    return service if key is None else f'{service}:{key}'
+
+
+def _load(service, key, now):
+    limits = RATE_LIMITS[service]
+    state = get_state(_name(service, key), default=None, doc='ratelimit') or {}
+    capacity = limits['per_minute']
+    tokens = state.get('tokens', capacity) + (now - state.get('ts', now)) * capacity / 60
+    day = _utc_day(now)
+    return {
+        'tokens': min(capacity, tokens),
+        'ts': now,
+        'day': day,
+        'used': state.get('used', 0) if state.get('day') == day else 0,
+        'blocked_until': state.get('blocked_until', 0),
+    }
+
+
+def _save(service, key, state):
+    state = {**state, 'tokens': round(state['tokens'], 3), 'ts': round(state['ts'], 3),
+             'blocked_until': round(state['blocked_until'], 3)}
+    set_state(_name(service, key), state, doc='ratelimit')
+
+
+def _decide(service, state, now):
+    limits = RATE_LIMITS[service]
+    per_day = limits.get('per_day')
+    if per_day is not None and state['used'] >= per_day:
+        return DEFER, _until_midnight(now)
+    if state['blocked_until'] > now:
+        wait = state['blocked_until'] - now
+    elif state['tokens'] < 1:
+        wait = (1 - state['tokens']) * 60 / limits['per_minute']
+    else:
+        return NOW, 0.0
+    return (WAIT if wait <= MAX_WAIT else DEFER), wait
+
+
+def check(service, key=None):
+    """Решение без траты токена: (NOW | WAIT | DEFER, сколько секунд ждать)."""
+    with _lock:
+        now = time.time()
+        return _decide(service, _load(service, key, now), now)
+
+
+def deferred(service, key=None):
+    return check(service, key)[0] == DEFER
+
+
+def remaining(service, key=None):
+    """Сколько запросов осталось в суточной квоте (None — квоты нет)."""
+    per_day = RATE_LIMITS[service].get('per_day')
+    if per_day is None:
+        return None
+    with _lock:
+        return max(0, per_day - _load(service, key, time.time())['used'])
+
+
+def acquire(service, key=None, max_wait=MAX_WAIT):
+    """Берёт токен на один вызов, если надо — подождав. True — можно
+    звать сервис, False — вызов отложен до следующего прогона (лимит на
+    сегодня исчерпан или ждать дольше max_wait)."""
+    deadline = time.time() + max_wait
+    while True:
+        with _lock:
+            now = time.time()
+            state = _load(service, key, now)
+            decision, wait = _decide(service, state, now)
+            if decision == NOW:
+                state['tokens'] -= 1
+                state['used'] += 1
+                _save(service, key, state)
+                return True
+        if decision == DEFER or now + wait > deadline:
+            logger.warning(f"{_name(service, key)}: лимит, вызов отложен до следующего прогона (ещё {wait:.0f} с)")
+            return False
+        logger.debug(f"{_name(service, key)}: лимит, жду {wait:.1f} с")
+        time.sleep(wait)
+
+
+def _retry_after(response):
+    # Telegram кладёт паузу в тело ответа (parameters.retry_after), OpenRouter
+    # и остальные — в заголовок Retry-After. У OpenRouter на исчерпанной
+    # суточной квоте вместо него X-RateLimit-Reset — момент сброса в мс.
+    try:
+        value = response.json().get('parameters', {}).get('retry_after')
+        if value is not None:
+            return float(value)
+    except (ValueError, AttributeError):
+        pass
+    value = http_client.retry_after(response)
+    if value is not None:
+        return value
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        try:
+            return max(0.0, int(response.headers['X-RateLimit-Reset']) / 1000 - time.time())
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+def throttled(service, response, key=None):
+    """Учитывает 429 от сервиса: до конца retry_after вызовы к нему ждут
+    или откладываются. Возвращает паузу в секундах."""
+    wait = _retry_after(response)
+    if wait is None:
+        wait = DEFAULT_BLOCK
+    with _lock:
+        now = time.time()
+        state = _load(service, key, now)
+        state['blocked_until'] = max(state['blocked_until'], now + wait)
+        _save(service, key, state)
+    logger.warning(f"{_name(service, key)}: HTTP 429, следующий вызов не раньше чем через {wait:.0f} с")
+    return wait
@@ -0,0 +1,178 @@
+import hashlib
+import mmap
+import os
+import struct
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# Индекс опубликованных статей: вместо полных URL в текстовом файле —
+# 64-битные отпечатки канонизированных URL, отсортированные в бинарном файле
+# фиксированной ширины. Файл открывается через mmap и ищется бинарным
+# поиском, так что старт и память не растут с историей (сотни тысяч постов =
+# единицы мегабайт на диске и почти ноль в RAM). Вероятность коллизии
+# 64-битного хэша на таком объёме ~1e-9 — пропустить из-за неё одну статью
+# не страшно.
+MAGIC = b'SEEN\x00\x00\x00\x01'
+# Запись: отпечаток (u64) + день добавления (u32, дни от эпохи). Big-endian,
+# чтобы порядок байтов совпадал с числовым порядком.
+RECORD = struct.Struct('>QI')
+
+# Параметры, которые не меняют статью, а только помечают, откуда пришёл
+# читатель: с ними один и тот же материал Habr/TechCrunch выглядел как разные
+# URL. fl=ru — языковой фильтр Habr из RSS-ссылок.
+TRACKING_PARAMS = {'fbclid', 'gclid', 'yclid', 'mc_cid', 'mc_eid', 'fl', 'ref', 'ref_src', 'source'}
+
+
+def canonical_url(url):
+    """Приводит URL к виду, по которому сравниваются статьи: без схемы
+    (http и https — одна статья), без www, без хвостового слэша, фрагмента
+    и трекинговых параметров, с отсортированными остальными параметрами."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f'{host}:{parts.port}'
+    path = parts.path.rstrip('/') or '/'
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS
+    )
+    return host + path + ('?' + urlencode(query) if query else '')
+
+
+def fingerprint(url):
+    digest = hashlib.blake2b(canonical_url(url).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def _today():
+    return int(time.time() // 86400)
+
+
+class SeenIndex:
+    """Множество опубликованных URL поверх отсортированного файла отпечатков.
+
+    Добавления за прогон копятся в памяти и в маленьком журнале рядом с
+    индексом (переживут падение процесса), а в сам индекс вливаются одной
+    перезаписью в flush()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = path.with_name(path.name + '.log')
+        self._pending = {}
+        self._file = None
+        self._map = None
+        self._count = 0
+        # День самой старой записи в файле: None — ещё не считали.
+        self._oldest = None
+
+    def open(self):
+        self.close()
+        if self.path.exists() and self.path.stat().st_size > len(MAGIC):
+            self._file = self.path.open('rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'{self.path}: не индекс опубликованных URL')
+            self._count = (len(self._map) - len(MAGIC)) // RECORD.size
+        # Журнал остаётся только после прерванного прогона — подхватываем.
+        if self.log_path.exists():
+            for line in self.log_path.read_text(encoding='ascii').splitlines():
+                fp, day = line.split()
+                self._pending[int(fp, 16)] = int(day)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = self._file = None
+        self._count = 0
+        self._oldest = None
+
+    def __len__(self):
+        return self._count + len(self._pending)
+
+    def _fp_at(self, i):
+        return RECORD.unpack_from(self._map, len(MAGIC) + i * RECORD.size)[0]
+
+    def _contains_fp(self, fp):
+        if fp in self._pending:
+            return True
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._fp_at(mid) < fp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self._count and self._fp_at(lo) == fp
+
+    def __contains__(self, url):
+        return self._contains_fp(fingerprint(url))
+
+    def add(self, url):
+        """Добавляет URL. False, если он (в канонической форме) уже был."""
+        fp = fingerprint(url)
+        if self._contains_fp(fp):
+            return False
+        day = _today()
+        self._pending[fp] = day
+        with self.log_path.open('a', encoding='ascii') as f:
+            f.write(f'{fp:016x} {day}\n')
+        return True
+
+    def _records(self):
+        for i in range(self._count):
+            yield RECORD.unpack_from(self._map, len(MAGIC) + i * RECORD.size)
+
+    def _oldest_day(self):
+        # Файл отсортирован по отпечатку, а не по дню — минимум ищется
+        # проходом, но один раз за процесс: дальше его поддерживает flush().
+        if self._oldest is None:
+            self._oldest = min((day for _, day in self._records()), default=_today())
+        return self._oldest
+
+    def flush(self, retention_days=None):
+        """Вливает накопленное в индекс (слиянием двух отсортированных
+        потоков, без загрузки индекса в память) и заодно выбрасывает записи
+        старше retention_days. Запись атомарная: временный файл + rename.
+        Если вливать нечего и выбрасывать тоже — файл не трогается: демон
+        сохраняет состояние после каждого опроса лент."""
+        cutoff = _today() - retention_days if retention_days else None
+        if not self._pending and (cutoff is None or self._oldest_day() >= cutoff):
+            return
+
+        pending = sorted(self._pending.items())
+        oldest = min((day for _, day in pending), default=_today())
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('wb') as out:
+            out.write(MAGIC)
+            j = 0
+            for fp, day in self._records():
+                while j < len(pending) and pending[j][0] < fp:
+                    out.write(RECORD.pack(*pending[j]))
+                    j += 1
+                if cutoff is None or day >= cutoff:
+                    out.write(RECORD.pack(fp, day))
+                    oldest = min(oldest, day)
+            for record in pending[j:]:
+                out.write(RECORD.pack(*record))
+            out.flush()
+            os.fsync(out.fileno())
+
+        self.close()
+        os.replace(tmp_path, self.path)
+        self.log_path.unlink(missing_ok=True)
+        self._pending = {}
+        self.open()
+        self._oldest = oldest
+
+    def migrate_from_text(self, text_path):
+        """Разовый перенос старого data/seen_urls.txt в индекс."""
+        day = _today()
+        for line in text_path.read_text(encoding='utf-8').splitlines():
+            if line.strip():
+                self._pending.setdefault(fingerprint(line.strip()), day)
+        self.flush()
+        text_path.unlink()
+
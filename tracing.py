@@ -0,0 +1,161 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+
+from loguru import logger
+
+from database import DATA_DIR
+
+# Лёгкая трассировка прогона: интервалы (span) с монотонным временем и
+# счётчики (байты, повторы, попадания в кэш, пропуски по причинам). В конце
+# прогона всё это ложится в data/runs/<время>.json и сводной таблицей в лог —
+# чтобы таймауты и квоты подбирать по данным, а не наугад.
+RUNS_DIR = DATA_DIR / 'runs'
+# Старые отчёты чистим: в git они не попадают (.gitignore), но на постоянной
+# машине копились бы бесконечно.
+RUNS_KEEP = 200
+# NEWS_BOT_PROFILE=cprofile|pyinstrument — заодно снять профиль всего прогона.
+PROFILE_ENV = 'NEWS_BOT_PROFILE'
+
+_spans = defaultdict(list)
+_counters = Counter()
+_lock = threading.Lock()
+_started_at = time.time()
+
+
+def reset():
+    global _started_at
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _started_at = time.time()
+
+
+@contextmanager
+def span(name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - started
+        with _lock:
+            _spans[name].append(duration)
+
+
+def traced(name):
+    """Декоратор: каждый вызов функции — интервал name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def skip(reason):
+    """Счётчик пропущенных кандидатов по причине."""
+    incr(f'skip.{reason}')
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def report():
+    with _lock:
+        spans = {
+            name: {
+                'count': len(values),
+                'total': round(sum(values), 4),
+                'p50': round(_percentile(values, 0.5), 4),
+                'p90': round(_percentile(values, 0.9), 4),
+                'max': round(max(values), 4),
+            }
+            for name, values in sorted(_spans.items())
+        }
+        counters = dict(sorted(_counters.items()))
+    return {
+        'started_at': datetime.fromtimestamp(_started_at, timezone.utc).isoformat(),
+        'duration': round(time.time() - _started_at, 4),
+        'spans': spans,
+        'counters': counters,
+    }
+
+
+def log_summary(data):
+    logger.info(f"{'интервал':<28}{'вызовов':>8}{'всего, с':>10}{'p50':>8}{'p90':>8}{'макс':>8}")
+    for name, values in data['spans'].items():
+        logger.info(
+            f"{name:<28}{values['count']:>8}{values['total']:>10.2f}"
+            f"{values['p50']:>8.2f}{values['p90']:>8.2f}{values['max']:>8.2f}"
+        )
+    if data['counters']:
+        logger.info('Счётчики: ' + ', '.join(f'{name}={value}' for name, value in data['counters'].items()))
+
+
+def write_report(**extra):
+    """Пишет отчёт прогона в RUNS_DIR и сводку в лог. extra — что ещё
+    положить в отчёт (статистика HTTP, число постов). Возвращает путь."""
+    data = {**report(), **extra}
+    log_summary(data)
+    RUNS_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.fromtimestamp(_started_at, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    path = RUNS_DIR / f'{stamp}.json'
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding='utf-8')
+    for old in sorted(RUNS_DIR.glob('*.json'))[:-RUNS_KEEP]:
+        old.unlink()
+    return path
+
+
+@contextmanager
+def profiled():
+    """Профилирует тело блока, если задан NEWS_BOT_PROFILE: cprofile (pstats
+    рядом с отчётами) или pyinstrument (HTML, если пакет установлен).
+    Профилируется поток, вызвавший блок, — стадии конвейера в своих потоках
+    видны по интервалам в отчёте, а не в профиле."""
+    mode = os.environ.get(PROFILE_ENV, '').lower()
+    if not mode:
+        yield
+        return
+
+    RUNS_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    if mode == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("pyinstrument не установлен — профилирую через cProfile")
+        else:
+            profiler = Profiler(async_mode='disabled')
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                path = RUNS_DIR / f'{stamp}.html'
+                path.write_text(profiler.output_html(), encoding='utf-8')
+                logger.info(f"Профиль прогона: {path}")
+            return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = RUNS_DIR / f'{stamp}.prof'
+        profiler.dump_stats(path)
+        logger.info(f"Профиль прогона: {path} (смотреть: python -m pstats {path})")